@@ -6,8 +6,23 @@ import uuid
 import re
 import csv
 import io
+import sys
+import sqlite3
+import threading
+import heapq
+import itertools
+import hashlib
+import bisect
+import weakref
+import mmap
+import struct
+from array import array
+import gzip
+import shlex
 from io import BytesIO, StringIO
-from datetime import datetime
+from collections import Counter, OrderedDict, defaultdict, deque
+from datetime import datetime, timedelta
+from pathlib import Path
 from typing import Dict, List, Optional, Set
 import aiofiles
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
@@ -21,10 +36,12 @@ from telegram.ext import (
     ConversationHandler,
     PicklePersistence,
 )
-from telegram.helpers import escape_markdown
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.helpers import escape_markdown, mention_html
 from functools import wraps
 import time
 import contextlib
+import copy
 import zipfile
 import tempfile
 import shutil
@@ -50,29 +67,231 @@ WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "your-secret-token")
 CONFIG_FILE = "configs.json"
 USERS_FILE = "users.txt"
 ORDERS_FILE = "orders.json"
+ORDERS_JOURNAL_FILE = "orders.journal"
+ORDERS_JOURNAL_COMPACTING_FILE = "orders.journal.compacting"
 BLACKLIST_FILE = "blacklist.txt"
 PERSISTENCE_FILE = "bot_data.pkl"
+WEBHOOK_STATE_FILE = "webhook_state.json"
 BACKUP_INTERVAL = int(os.getenv("BACKUP_INTERVAL_SECONDS", 24 * 3600))
+BACKUP_FULL_EVERY = int(os.getenv("BACKUP_FULL_EVERY", 7))
+NOTIFY_RETRIES = int(os.getenv("NOTIFY_RETRIES", 3))
+RESERVATION_TTL = int(os.getenv("RESERVATION_TTL_SECONDS", 30 * 60))
+WEBHOOK_DEDUP_WINDOW = int(os.getenv("WEBHOOK_DEDUP_WINDOW", 10000))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 4))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", 8))
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", 25))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", 1))
+OUTBOUND_GROUP_RATE = float(os.getenv("OUTBOUND_GROUP_RATE", 20 / 60))
+OUTBOX_RETRY_INTERVAL = int(os.getenv("OUTBOX_RETRY_INTERVAL_SECONDS", 60))
+JOURNAL_COMPACT_THRESHOLD = int(os.getenv("JOURNAL_COMPACT_THRESHOLD", 1000))
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "file").lower()
+SQLITE_FILE = os.getenv("SQLITE_FILE", "manava.db")
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL_SECONDS", 2))
+USER_FLUSH_BATCH = int(os.getenv("USER_FLUSH_BATCH", 500))
+# بودجه هر نوع درخواست: تعداد مجاز / بازه به ثانیه
+RATE_LIMITS = os.getenv("RATE_LIMITS", "default=5/10,start=1/10,callback=5/5,receipt=1/10")
+RATE_LIMIT_MAX_USERS = int(os.getenv("RATE_LIMIT_MAX_USERS", 50000))
+RATE_LIMIT_EXEMPT_ADMINS = os.getenv("RATE_LIMIT_EXEMPT_ADMINS", "1").lower() not in ("0", "false", "no")
+MENU_CACHE_SIZE = int(os.getenv("MENU_CACHE_SIZE", 256))
+EXPORT_SPOOL_SIZE = int(os.getenv("EXPORT_SPOOL_SIZE", 1024 * 1024))
+
+# Compact ID sets
+class IntSet:
+    """Set of int64 IDs stored as a sorted array plus small sets of recent changes.
+
+    Membership is a set lookup for recent changes and a binary search on the
+    array otherwise; the array costs 8 bytes per member instead of a set entry
+    and boxed int. Changes are folded into the array once they pile up.
+    """
+
+    MERGE_THRESHOLD = 4096
+
+    def __init__(self, values=()):
+        self._base = array('q', sorted(set(values)))
+        self._added: Set[int] = set()
+        self._removed: Set[int] = set()
+
+    @classmethod
+    def from_sorted(cls, base: array) -> "IntSet":
+        """Wrap an already sorted, duplicate-free array without copying it."""
+        ids = cls()
+        ids._base = base
+        return ids
+
+    def _in_base(self, value: int) -> bool:
+        i = bisect.bisect_left(self._base, value)
+        return i < len(self._base) and self._base[i] == value
+
+    def __contains__(self, value) -> bool:
+        if not isinstance(value, int):
+            return False
+        if value in self._added:
+            return True
+        if value in self._removed:
+            return False
+        return self._in_base(value)
+
+    def __len__(self) -> int:
+        return len(self._base) - len(self._removed) + len(self._added)
+
+    def __iter__(self):
+        base = (v for v in self._base if v not in self._removed) if self._removed else iter(self._base)
+        return heapq.merge(base, sorted(self._added))
+
+    def add(self, value: int):
+        if value in self._removed:
+            self._removed.discard(value)
+        elif not self._in_base(value):
+            self._added.add(value)
+            self._maybe_merge()
+
+    def update(self, values):
+        values = set(values)
+        if len(values) < self.MERGE_THRESHOLD:
+            for value in values:
+                self.add(value)
+            return
+        merged = heapq.merge(iter(self), sorted(values))
+        self._base = array('q', (value for value, _ in itertools.groupby(merged)))
+        self._added = set()
+        self._removed = set()
+
+    def discard(self, value: int):
+        if value in self._added:
+            self._added.discard(value)
+        elif self._in_base(value):
+            self._removed.add(value)
+            self._maybe_merge()
+
+    def _maybe_merge(self):
+        if len(self._added) + len(self._removed) >= self.MERGE_THRESHOLD:
+            self._merge()
+
+    def _merge(self):
+        self._base = array('q', iter(self))
+        self._added = set()
+        self._removed = set()
+
+    def sorted_array(self) -> array:
+        if self._added or self._removed:
+            self._merge()
+        return self._base
+
+    def copy(self) -> "IntSet":
+        return IntSet.from_sorted(array('q', self.sorted_array()))
+
+    def __or__(self, other) -> "IntSet":
+        merged = self.copy()
+        merged.update(other)
+        return merged
+
+# Binary ID index: magic, member count and the users.txt byte offset it covers, then little-endian int64s
+ID_INDEX_MAGIC = b"MNVIDX2\n"
+# magic, id count, covered text bytes, digest of the covered text
+ID_INDEX_HEADER = struct.Struct("<8sqq16s")
+ID_INDEX_CHUNK = 1 << 20
+
+def id_text_hasher():
+    return hashlib.blake2b(digest_size=16)
+
+def read_id_index(path: str) -> Optional[tuple]:
+    """Return (ids, covered text bytes, digest) from a binary index, or None if it is missing or invalid."""
+    if not os.path.exists(path) or os.path.getsize(path) < ID_INDEX_HEADER.size:
+        return None
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        magic, count, covered, digest = ID_INDEX_HEADER.unpack_from(mm, 0)
+        end = ID_INDEX_HEADER.size + count * 8
+        if magic != ID_INDEX_MAGIC or len(mm) < end:
+            return None
+        base = array('q')
+        base.frombytes(mm[ID_INDEX_HEADER.size:end])
+    if sys.byteorder != "little":
+        base.byteswap()
+    return IntSet.from_sorted(base), covered, digest
+
+def write_id_index(path: str, ids: IntSet, covered: int, digest: bytes):
+    base = ids.sorted_array()
+    if sys.byteorder != "little":
+        base = array('q', base)
+        base.byteswap()
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(ID_INDEX_HEADER.pack(ID_INDEX_MAGIC, len(base), covered, digest))
+        f.write(base.tobytes())
+    os.replace(tmp, path)
+
+def load_id_file(path: str) -> IntSet:
+    """Load an ID text file through its binary index, parsing only lines appended since the index was written.
+
+    The index is only trusted if the text it covers still hashes to the
+    recorded digest, so a hand edit of the file falls back to a full parse.
+    """
+    if not os.path.exists(path):
+        return IntSet()
+    index_path = f"{path}.idx"
+    text_size = os.path.getsize(path)
+    indexed = read_id_index(index_path)
+    with open(path, "rb") as f:
+        hasher = id_text_hasher()
+        ids, covered = IntSet(), 0
+        if indexed is not None and indexed[1] <= text_size:
+            remaining = indexed[1]
+            while remaining:
+                chunk = f.read(min(remaining, ID_INDEX_CHUNK))
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                remaining -= len(chunk)
+            if not remaining and hasher.digest() == indexed[2]:
+                ids, covered = indexed[0], indexed[1]
+            else:
+                logger.info(f"{path} changed since its index was written; rebuilding the index")
+                hasher = id_text_hasher()
+        if covered == text_size:
+            return ids
+        f.seek(covered)
+        tail = f.read()
+    # خط ناقص آخر (بدون newline) در دفعه بعد خوانده می‌شود
+    complete = tail.rfind(b"\n") + 1
+    ids.update(int(token) for token in tail[:complete].split() if token.isdigit())
+    hasher.update(tail[:complete])
+    write_id_index(index_path, ids, covered + complete, hasher.digest())
+    return ids
+
+def write_id_file(path: str, ids) -> None:
+    if not isinstance(ids, IntSet):
+        ids = IntSet(ids)
+    hasher = id_text_hasher()
+    covered = 0
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        for user_id in ids:
+            line = f"{user_id}\n".encode("ascii")
+            f.write(line)
+            hasher.update(line)
+            covered += len(line)
+    os.replace(tmp, path)
+    write_id_index(f"{path}.idx", ids, covered, hasher.digest())
 
 # Global counters and caches
-users_cache: Set[int] = set()
+users_cache = IntSet()
 orders: Dict[str, Dict] = {}
 configs: Dict[int, Dict] = {}
-blacklist: Set[int] = set()
+blacklist = IntSet()
 config_id_counter = 1
-processed_updates: Set[int] = set()  # Added to track processed update_ids
 
 # Locks for concurrency
-orders_lock = asyncio.Lock()
-configs_lock = asyncio.Lock()
 users_lock = asyncio.Lock()
 blacklist_lock = asyncio.Lock()
 
-# Simple rate limiter
-rate_limiter: Dict[int, float] = {}
+# Background orders compaction
+compaction_task: Optional[asyncio.Task] = None
 
 # Pagination settings
 ORDERS_PER_PAGE = 5
+GROUPS_PER_PAGE = 8
+CONFIGS_PER_PAGE = 8
 
 # Conversation States
 ADD_CONFIG_VOLUME, ADD_CONFIG_DURATION, ADD_CONFIG_PRICE, ADD_CONFIG_LINK = range(4)
@@ -91,6 +310,14 @@ def csv_safe(s: Optional[str]) -> str:
         return "'" + s
     return s
 
+# پاکسازی لینک از mentionهای اضافی
+LINK_CLEANUP_PATTERNS = [re.compile(r'--@ghalagyann2'), re.compile(r'----@Shh_Proxy')]
+
+def clean_config_link(link: str) -> str:
+    for pattern in LINK_CLEANUP_PATTERNS:
+        link = pattern.sub('', link)
+    return link.strip()
+
 async def atomic_write(path: str, data: str):
     tmp = f"{path}.tmp"
     async with aiofiles.open(tmp, "w", encoding="utf-8") as f:
@@ -104,17 +331,1378 @@ def redact_card(num: Optional[str]) -> str:
         return "**** **** **** " + num[-4:]
     return "****"
 
-def is_rate_limited(user_id: int, window: int = 10) -> bool:
-    now = time.monotonic()
-    last = rate_limiter.get(user_id, 0)
-    limited = (now - last) < window
-    rate_limiter[user_id] = now
-    if len(rate_limiter) > 10000:
-        cutoff = now - 300
-        for k, v in list(rate_limiter.items()):
-            if v < cutoff:
-                rate_limiter.pop(k, None)
-    return limited
+class StateGate:
+    """Shared/exclusive barrier between ordinary state changes and a restore.
+
+    Order and config critical sections hold it shared (through the keyed
+    locks below); a restore holds it exclusively, so no change can start
+    before the swap and persist after it. Re-entrant per task, so a task that
+    already holds it never waits behind a pending restore.
+    """
+
+    def __init__(self):
+        self._shared: Dict[asyncio.Task, int] = {}
+        self._exclusive: Optional[asyncio.Task] = None
+        self._exclusive_waiting = 0
+        self._waiters: List[asyncio.Future] = []
+
+    async def _wait(self):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        await waiter
+
+    def _wake(self):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def shared(self):
+        task = asyncio.current_task()
+        if task not in self._shared and self._exclusive is not task:
+            while self._exclusive is not None or self._exclusive_waiting:
+                await self._wait()
+        self._shared[task] = self._shared.get(task, 0) + 1
+        try:
+            yield
+        finally:
+            if self._shared[task] == 1:
+                del self._shared[task]
+                if not self._shared:
+                    self._wake()
+            else:
+                self._shared[task] -= 1
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self):
+        self._exclusive_waiting += 1
+        try:
+            while self._exclusive is not None or self._shared:
+                await self._wait()
+        finally:
+            self._exclusive_waiting -= 1
+        self._exclusive = asyncio.current_task()
+        try:
+            yield
+        finally:
+            self._exclusive = None
+            self._wake()
+
+state_gate = StateGate()
+
+class KeyedLocks:
+    """One asyncio.Lock per key (order ID, config ID); idle locks are dropped automatically.
+
+    Holding a key also holds state_gate shared, so restores wait for it.
+    """
+
+    def __init__(self):
+        self._locks: "weakref.WeakValueDictionary" = weakref.WeakValueDictionary()
+
+    def _lock(self, key) -> asyncio.Lock:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, key):
+        async with state_gate.shared():
+            async with self._lock(key):
+                yield
+
+    @contextlib.asynccontextmanager
+    async def hold(self, keys):
+        """Acquire the locks of several keys in a fixed order so batches cannot deadlock."""
+        async with contextlib.AsyncExitStack() as stack:
+            for key in sorted(set(keys), key=str):
+                await stack.enter_async_context(self(key))
+            yield
+
+order_locks = KeyedLocks()
+config_locks = KeyedLocks()
+
+def approval_text(order_id: str, link: str) -> str:
+    return (
+        f"✅ پرداخت شما تأیید شد!\n🎉 کانفیگ شما:\n`{md_escape(link)}`\n\n"
+        f"ID سفارش: `{md_escape(order_id)}`\n💡 برای کپی ID، روی آن لمس کنید."
+    )
+
+def rejection_text(order_id: str) -> str:
+    return (
+        "❌ پرداخت شما رد شد!\n⚠️ لطفاً به پشتیبانی مراجعه کنید: @manava_vpn\n\n"
+        f"ID سفارش: `{md_escape(order_id)}`\n💡 برای کپی ID، روی آن لمس کنید."
+    )
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    delay = error.retry_after
+    return delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+
+# Rate limiting
+def parse_rate_limits(spec: str) -> Dict[str, tuple]:
+    """Parse "action=capacity/seconds,..." into {action: (capacity, refill per second)}."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        try:
+            action, budget = item.split("=", 1)
+            capacity, period = (float(value) for value in budget.split("/", 1))
+            # nan هم در این مقایسه رد می‌شود
+            if not (0 < capacity < float("inf") and 0 < period < float("inf")):
+                raise ValueError(f"non-positive budget {budget!r}")
+            limits[action.strip()] = (capacity, capacity / period)
+        except (ValueError, ZeroDivisionError):
+            logger.warning(f"Ignoring invalid rate limit {item!r}")
+    return limits
+
+class RateLimiter:
+    """Token bucket per (action class, user).
+
+    Each action keeps its buckets in an OrderedDict ordered by last use, so
+    buckets that have refilled completely sit at the front and are dropped a
+    few at a time on later calls instead of sweeping the whole table.
+    A rejected request does not spend a token.
+    """
+
+    PRUNE_PER_CALL = 8
+
+    def __init__(self, limits: Dict[str, tuple], max_users: int):
+        self.limits = limits
+        self.max_users = max(1, max_users)
+        self._buckets: Dict[str, OrderedDict] = defaultdict(OrderedDict)
+        self.rejected: Counter = Counter()
+
+    def _prune(self, buckets: OrderedDict, idle_after: float, now: float, caller: int):
+        for _ in range(self.PRUNE_PER_CALL):
+            if not buckets:
+                return
+            user_id, (_, updated) = next(iter(buckets.items()))
+            if user_id == caller and len(buckets) > 1:
+                # سطل خود درخواست‌دهنده حذف نمی‌شود وگرنه با سطل پر از محدودیت عبور می‌کند
+                buckets.move_to_end(user_id)
+                continue
+            if now - updated < idle_after and len(buckets) < self.max_users:
+                return
+            if user_id == caller:
+                return
+            buckets.popitem(last=False)
+
+    def hit(self, user_id: int, action: str) -> bool:
+        """Spend one token for the action; False if the user is over budget."""
+        limit = self.limits.get(action) or self.limits.get("default")
+        if limit is None:
+            return True
+        capacity, rate = limit
+        now = time.monotonic()
+        buckets = self._buckets[action]
+        self._prune(buckets, capacity / rate, now, user_id)
+        tokens, updated = buckets.get(user_id, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        if tokens < 1:
+            self.rejected[action] += 1
+            return False
+        buckets[user_id] = (tokens - 1, now)
+        buckets.move_to_end(user_id)
+        return True
+
+    def metrics(self) -> Dict[str, int]:
+        result = {f"rate_limited_{action}": count for action, count in self.rejected.items()}
+        result["rate_limit_buckets"] = sum(len(b) for b in self._buckets.values())
+        return result
+
+rate_limiter = RateLimiter(parse_rate_limits(RATE_LIMITS), RATE_LIMIT_MAX_USERS)
+
+def is_rate_limited(user_id: int, action: str = "default") -> bool:
+    if RATE_LIMIT_EXEMPT_ADMINS and user_id in ADMIN_IDS:
+        return False
+    return not rate_limiter.hit(user_id, action)
+
+# Outbound message scheduling
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+class OutboundDispatcher:
+    """Central queue for Bot API calls with global and per-chat token buckets, priorities and retries.
+
+    Bot-initiated sends (notifications, admin fan-out, broadcasts, backups) go
+    through here. Direct replies to a user's own update (reply_text,
+    edit_message_text on a callback) stay inline: they are bounded by that
+    user's input rate and the per-user rate limiter.
+    """
+
+    PRIORITY_USER = 0
+    PRIORITY_ADMIN = 1
+    PRIORITY_CAPTION = 2
+    PRIORITY_BACKGROUND = 3
+
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, workers: int, global_rate: float, chat_rate: float, group_rate: float, attempts: int):
+        self.workers = max(1, workers)
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.attempts = max(1, attempts)
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._seq = itertools.count()
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self._paused_until = 0.0
+        self._tasks: List[asyncio.Task] = []
+        # کارهای چت‌هایی که سهمیه‌شان تمام شده، بدون اشغال worker منتظر می‌مانند
+        self._parked: Dict[int, List[tuple]] = {}
+        self.sent = 0
+        self.failed = 0
+
+    def start(self):
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _drain(self):
+        while True:
+            await self._queue.join()
+            if not self._parked:
+                return
+            await asyncio.sleep(0.05)
+
+    async def stop(self, timeout: float = 10.0):
+        if self._queue is not None:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._drain(), timeout)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, func, *args, chat_id: int, priority: int = PRIORITY_USER, description: str = "", **kwargs) -> asyncio.Future:
+        """Queue a Bot API call; the returned future resolves to its result."""
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: self._log_failure(f, description or func.__name__, chat_id))
+        job = {'func': func, 'args': args, 'kwargs': {'chat_id': chat_id, **kwargs}, 'chat_id': chat_id, 'future': future,
+               'attempt': 1, 'seq': next(self._seq)}
+        if self._queue is None:
+            # قبل از راه‌اندازی (مثلاً در اسکریپت‌ها) مستقیم ارسال می‌شود
+            asyncio.get_running_loop().create_task(self._execute(priority, job))
+        else:
+            self._queue.put_nowait((priority, job['seq'], job))
+        return future
+
+    async def send(self, func, *args, chat_id: int, priority: int = PRIORITY_USER, **kwargs):
+        return await self.submit(func, *args, chat_id=chat_id, priority=priority, **kwargs)
+
+    @staticmethod
+    def _log_failure(future: asyncio.Future, description: str, chat_id: int):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            logger.error(f"Outbound {description} to {chat_id} failed: {error}")
+
+    def metrics(self) -> Dict:
+        return {
+            "outbound_queue_depth": self._queue.qsize() if self._queue else 0,
+            "outbound_parked": sum(len(jobs) for jobs in self._parked.values()),
+            "outbound_sent": self.sent,
+            "outbound_failed": self.failed,
+        }
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, 1)
+            if len(self._chats) > self.MAX_CHAT_BUCKETS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _acquire(self, priority: int, job: Dict) -> bool:
+        """Take a global and a chat token; False if the job was parked until its chat refills."""
+        chat_id = job['chat_id']
+        while True:
+            now = time.monotonic()
+            chat = self._chat_bucket(chat_id)
+            chat_wait = chat.wait_time(now)
+            if self._queue is not None and (chat_wait > 0 or (chat_id in self._parked and not job.get('released'))):
+                self._park(priority, job, chat_wait)
+                return False
+            wait = max(self._paused_until - now, self._global.wait_time(now), chat_wait)
+            if wait <= 0:
+                self._global.consume()
+                chat.consume()
+                return True
+            # سقف سراسری برای همه چت‌ها یکسان است، پس صبر در worker اشکالی ندارد
+            await asyncio.sleep(wait)
+
+    def _park(self, priority: int, job: Dict, wait: float):
+        chat_id = job['chat_id']
+        job.pop('released', None)
+        parked = self._parked.get(chat_id)
+        if parked is None:
+            parked = self._parked[chat_id] = []
+            asyncio.get_running_loop().call_later(max(wait, 0.0), self._release, chat_id)
+        heapq.heappush(parked, (priority, job['seq'], job))
+
+    def _release(self, chat_id: int):
+        """Hand the next parked job of a chat back to the workers once a token is available."""
+        parked = self._parked.get(chat_id)
+        if not parked:
+            self._parked.pop(chat_id, None)
+            return
+        wait = self._chat_bucket(chat_id).wait_time(time.monotonic())
+        if wait <= 0:
+            priority, seq, job = heapq.heappop(parked)
+            job['released'] = True
+            self._queue.put_nowait((priority, seq, job))
+            if not parked:
+                del self._parked[chat_id]
+                return
+            wait = 1 / self._chat_bucket(chat_id).rate
+        asyncio.get_running_loop().call_later(wait, self._release, chat_id)
+
+    async def _worker(self):
+        while True:
+            priority, _, job = await self._queue.get()
+            try:
+                await self._execute(priority, job)
+            except Exception as e:
+                # یک کار خراب نباید worker را برای همیشه از کار بیندازد
+                logger.exception(f"Outbound worker error for chat {job.get('chat_id')}: {e}")
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, result=None, error: Optional[Exception] = None):
+        """Settle a job's future unless the caller already cancelled it."""
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    async def _execute(self, priority: int, job: Dict):
+        future = job['future']
+        if future.done():
+            return
+        if not await self._acquire(priority, job):
+            return
+        try:
+            result = await job['func'](*job['args'], **job['kwargs'])
+        except RetryAfter as e:
+            # محدودیت تلگرام: کل ارسال‌ها تا پایان مهلت متوقف می‌شوند
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after_seconds(e))
+            self._retry(priority, job, e)
+        except BadRequest as e:
+            self.failed += 1
+            self._resolve(future, error=e)
+        except NetworkError as e:
+            self._retry(priority, job, e, delay=2 ** job['attempt'])
+        except Exception as e:
+            self.failed += 1
+            self._resolve(future, error=e)
+        else:
+            self.sent += 1
+            self._resolve(future, result)
+
+    def _retry(self, priority: int, job: Dict, error: Exception, delay: float = 0.0):
+        if job['attempt'] >= self.attempts:
+            self.failed += 1
+            self._resolve(job['future'], error=error)
+            return
+        job['attempt'] += 1
+
+        def requeue():
+            if job['future'].done():
+                return
+            if self._queue is None:
+                asyncio.get_running_loop().create_task(self._execute(priority, job))
+            else:
+                self._queue.put_nowait((priority, next(self._seq), job))
+        asyncio.get_running_loop().call_later(delay, requeue)
+
+outbound = OutboundDispatcher(
+    OUTBOUND_WORKERS, OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_GROUP_RATE, NOTIFY_RETRIES
+)
+
+# Storage Backends
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS blacklist (user_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS configs (id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS orders (
+    order_id TEXT PRIMARY KEY,
+    user_id INTEGER,
+    status TEXT,
+    timestamp TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status);
+CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders(user_id);
+CREATE INDEX IF NOT EXISTS idx_orders_timestamp ON orders(timestamp);
+CREATE INDEX IF NOT EXISTS idx_orders_outbox ON orders(order_id) WHERE json_extract(data, '$.outbox') IS NOT NULL;
+"""
+
+def compact_json(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=str)
+
+class StorageBackend:
+    """Persistence interface used by DataManager; one implementation per storage format."""
+
+    # True if load_orders() returns the full order history, False if only open orders
+    keeps_history_in_memory = True
+
+    def available_datasets(self) -> Set[str]:
+        return {"users", "blacklist", "configs", "orders"}
+
+    async def load_users(self) -> IntSet:
+        raise NotImplementedError
+
+    async def add_users(self, user_ids: List[int]):
+        raise NotImplementedError
+
+    async def replace_users(self, user_ids: Set[int]):
+        raise NotImplementedError
+
+    async def load_blacklist(self) -> IntSet:
+        raise NotImplementedError
+
+    async def save_blacklist(self, user_ids: Set[int]):
+        raise NotImplementedError
+
+    async def load_configs(self) -> List[Dict]:
+        raise NotImplementedError
+
+    async def save_configs(self, all_configs: Dict[int, Dict], changed: List[Dict], removed: List[int]):
+        raise NotImplementedError
+
+    async def replace_configs(self, all_configs: List[Dict]):
+        raise NotImplementedError
+
+    async def load_orders(self) -> Dict[str, Dict]:
+        raise NotImplementedError
+
+    async def all_orders(self) -> Dict[str, Dict]:
+        raise NotImplementedError
+
+    async def put_orders(self, records: List[tuple]):
+        """Persist (order_id, order) pairs; an order of None deletes the record."""
+        raise NotImplementedError
+
+    async def replace_orders(self, all_orders: Dict[str, Dict]):
+        raise NotImplementedError
+
+    async def compact_orders(self, all_orders: Dict[str, Dict]):
+        pass
+
+    def needs_compaction(self) -> bool:
+        return False
+
+    async def get_order(self, order_id: str) -> Optional[Dict]:
+        return None
+
+    def iter_orders(self, filters: Dict):
+        raise NotImplementedError
+
+    async def order_summaries(self) -> List[tuple]:
+        """(status, timestamp, group key, price) for every stored order."""
+        raise NotImplementedError
+
+    async def backup_paths(self, tmp_dir: str) -> List[str]:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    async def import_from(self, source: "StorageBackend") -> List[str]:
+        imported = []
+        datasets = source.available_datasets()
+        if "configs" in datasets:
+            await self.replace_configs(await source.load_configs())
+            imported.append("configs")
+        if "orders" in datasets:
+            await self.replace_orders(await source.all_orders())
+            imported.append("orders")
+        if "users" in datasets:
+            await self.replace_users(await source.load_users())
+            imported.append("users")
+        if "blacklist" in datasets:
+            await self.save_blacklist(await source.load_blacklist())
+            imported.append("blacklist")
+        return imported
+
+class FileStorage(StorageBackend):
+    """JSON/TXT flat files; orders are a snapshot plus an append-only journal."""
+
+    keeps_history_in_memory = True
+
+    def __init__(self, base_dir: str = "."):
+        self.config_file = os.path.join(base_dir, CONFIG_FILE)
+        self.users_file = os.path.join(base_dir, USERS_FILE)
+        self.orders_file = os.path.join(base_dir, ORDERS_FILE)
+        self.journal_file = os.path.join(base_dir, ORDERS_JOURNAL_FILE)
+        self.compacting_file = os.path.join(base_dir, ORDERS_JOURNAL_COMPACTING_FILE)
+        self.blacklist_file = os.path.join(base_dir, BLACKLIST_FILE)
+        self.journal_lock = asyncio.Lock()
+        self.compaction_lock = asyncio.Lock()
+        self.configs_write_lock = asyncio.Lock()
+        self.journal_records = 0
+
+    def available_datasets(self) -> Set[str]:
+        found = set()
+        if os.path.exists(self.config_file):
+            found.add("configs")
+        if os.path.exists(self.orders_file) or os.path.exists(self.journal_file):
+            found.add("orders")
+        if os.path.exists(self.users_file):
+            found.add("users")
+        if os.path.exists(self.blacklist_file):
+            found.add("blacklist")
+        return found
+
+    @staticmethod
+    async def _read_id_file(path: str) -> IntSet:
+        return await asyncio.to_thread(load_id_file, path)
+
+    @staticmethod
+    async def _write_id_file(path: str, user_ids):
+        await asyncio.to_thread(write_id_file, path, user_ids)
+
+    async def load_users(self) -> IntSet:
+        return await self._read_id_file(self.users_file)
+
+    async def add_users(self, user_ids: List[int]):
+        async with aiofiles.open(self.users_file, "a", encoding="utf-8") as f:
+            await f.write("".join(f"{user_id}\n" for user_id in user_ids))
+
+    async def replace_users(self, user_ids: Set[int]):
+        await self._write_id_file(self.users_file, user_ids)
+
+    async def load_blacklist(self) -> IntSet:
+        return await self._read_id_file(self.blacklist_file)
+
+    async def save_blacklist(self, user_ids: Set[int]):
+        await self._write_id_file(self.blacklist_file, user_ids)
+
+    async def load_configs(self) -> List[Dict]:
+        if not os.path.exists(self.config_file):
+            return []
+        async with aiofiles.open(self.config_file, "r", encoding="utf-8") as f:
+            content = await f.read()
+        return json.loads(content)
+
+    async def save_configs(self, all_configs: Dict[int, Dict], changed: List[Dict], removed: List[int]):
+        await self.replace_configs(list(all_configs.values()))
+
+    async def replace_configs(self, all_configs: List[Dict]):
+        # قفل‌های هر کانفیگ مستقل‌اند ولی فایل مشترک است
+        async with self.configs_write_lock:
+            await atomic_write(self.config_file, json.dumps(all_configs, ensure_ascii=False, indent=2))
+
+    @staticmethod
+    def _replay_journal(path: str, into: Dict[str, Dict]) -> int:
+        """Apply journal records from path onto into; returns the number applied."""
+        applied = 0
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # رکورد ناقص (مثلاً قطع برق وسط نوشتن) نادیده گرفته می‌شود
+                    logger.warning(f"Skipping corrupt journal record in {path}")
+                    continue
+                order_id = record.get("id")
+                if not order_id:
+                    continue
+                if record.get("order") is None:
+                    into.pop(order_id, None)
+                else:
+                    into[order_id] = record["order"]
+                applied += 1
+        return applied
+
+    async def load_orders(self) -> Dict[str, Dict]:
+        loaded: Dict[str, Dict] = {}
+        if os.path.exists(self.orders_file):
+            async with aiofiles.open(self.orders_file, "r", encoding="utf-8") as f:
+                content = await f.read()
+            loaded = json.loads(content)
+        replayed = 0
+        for path in (self.compacting_file, self.journal_file):
+            if os.path.exists(path):
+                try:
+                    replayed += await asyncio.to_thread(self._replay_journal, path, loaded)
+                except Exception as e:
+                    logger.error(f"Error replaying journal {path}: {e}")
+        if replayed:
+            logger.info(f"Replayed {replayed} journal records into orders")
+            await self.compact_orders(loaded)
+        return loaded
+
+    async def all_orders(self) -> Dict[str, Dict]:
+        return await self.load_orders()
+
+    async def put_orders(self, records: List[tuple]):
+        lines = [compact_json({"id": order_id, "order": order}) for order_id, order in records]
+        if not lines:
+            return
+        async with self.journal_lock:
+            async with aiofiles.open(self.journal_file, "a", encoding="utf-8") as f:
+                await f.write("\n".join(lines) + "\n")
+            self.journal_records += len(lines)
+
+    def needs_compaction(self) -> bool:
+        return self.journal_records >= JOURNAL_COMPACT_THRESHOLD
+
+    def _rotate_journal(self):
+        """Move the live journal aside, keeping any records left by a compaction that failed earlier."""
+        if not os.path.exists(self.journal_file):
+            return
+        if not os.path.exists(self.compacting_file):
+            os.replace(self.journal_file, self.compacting_file)
+            return
+        with open(self.compacting_file, "ab") as out, open(self.journal_file, "rb") as src:
+            # رکورد ناقص انتهای فایل قبلی نباید به اولین رکورد جدید بچسبد
+            out.write(b"\n")
+            shutil.copyfileobj(src, out)
+            out.flush()
+            os.fsync(out.fileno())
+        os.remove(self.journal_file)
+
+    async def compact_orders(self, all_orders: Dict[str, Dict]):
+        """Write a full snapshot of orders and drop the journal records it covers."""
+        async with self.compaction_lock:
+            async with self.journal_lock:
+                self._rotate_journal()
+                snapshot = {oid: dict(o) for oid, o in all_orders.items()}
+                self.journal_records = 0
+            data = await asyncio.to_thread(compact_json, snapshot)
+            await atomic_write(self.orders_file, data)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.compacting_file)
+
+    async def replace_orders(self, all_orders: Dict[str, Dict]):
+        await self.compact_orders(all_orders)
+
+    async def order_summaries(self) -> List[tuple]:
+        return [order_summary(o) for o in (await self.load_orders()).values()]
+
+    async def backup_paths(self, tmp_dir: str) -> List[str]:
+        """Copy the data files into tmp_dir while no compaction or journal append can touch them."""
+        paths = [self.config_file, self.orders_file, self.journal_file, self.users_file, self.blacklist_file]
+
+        def copy_files() -> List[str]:
+            copied = []
+            for src in paths:
+                if os.path.exists(src):
+                    dst = os.path.join(tmp_dir, os.path.basename(src))
+                    shutil.copyfile(src, dst)
+                    copied.append(dst)
+            return copied
+        async with self.compaction_lock:
+            async with self.journal_lock:
+                return await asyncio.to_thread(copy_files)
+
+class SQLiteStorage(StorageBackend):
+    """SQLite database in WAL mode; only open orders are kept in memory."""
+
+    keeps_history_in_memory = False
+
+    def __init__(self, path: str = None):
+        self.path = path or SQLITE_FILE
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SQLITE_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, fn, *args):
+        def call():
+            with self._db_lock:
+                conn = self._connect()
+                with conn:
+                    return fn(conn, *args)
+        return await asyncio.to_thread(call)
+
+    @staticmethod
+    def _order_row(order_id: str, order: Dict) -> tuple:
+        return (order_id, order.get('user_id'), order.get('status'), order.get('timestamp'), compact_json(order))
+
+    async def load_users(self) -> IntSet:
+        return await self._run(lambda conn: IntSet.from_sorted(
+            array('q', (row[0] for row in conn.execute("SELECT user_id FROM users ORDER BY user_id")))))
+
+    async def add_users(self, user_ids: List[int]):
+        await self._run(lambda conn: conn.executemany(
+            "INSERT OR IGNORE INTO users (user_id) VALUES (?)", [(uid,) for uid in user_ids]))
+
+    async def replace_users(self, user_ids: Set[int]):
+        def replace(conn):
+            conn.execute("DELETE FROM users")
+            conn.executemany("INSERT INTO users (user_id) VALUES (?)", [(uid,) for uid in user_ids])
+        await self._run(replace)
+
+    async def load_blacklist(self) -> IntSet:
+        return await self._run(lambda conn: IntSet.from_sorted(
+            array('q', (row[0] for row in conn.execute("SELECT user_id FROM blacklist ORDER BY user_id")))))
+
+    async def save_blacklist(self, user_ids: Set[int]):
+        def replace(conn):
+            conn.execute("DELETE FROM blacklist")
+            conn.executemany("INSERT INTO blacklist (user_id) VALUES (?)", [(uid,) for uid in user_ids])
+        await self._run(replace)
+
+    async def load_configs(self) -> List[Dict]:
+        return await self._run(lambda conn: [json.loads(row[0]) for row in conn.execute("SELECT data FROM configs ORDER BY id")])
+
+    async def save_configs(self, all_configs: Dict[int, Dict], changed: List[Dict], removed: List[int]):
+        def apply(conn):
+            conn.executemany("DELETE FROM configs WHERE id = ?", [(int(cid),) for cid in removed])
+            conn.executemany(
+                "INSERT OR REPLACE INTO configs (id, data) VALUES (?, ?)",
+                [(int(cfg['id']), compact_json(cfg)) for cfg in changed],
+            )
+        await self._run(apply)
+
+    async def replace_configs(self, all_configs: List[Dict]):
+        def replace(conn):
+            conn.execute("DELETE FROM configs")
+            conn.executemany(
+                "INSERT INTO configs (id, data) VALUES (?, ?)",
+                [(int(cfg['id']), compact_json(cfg)) for cfg in all_configs if "id" in cfg],
+            )
+        await self._run(replace)
+
+    async def load_orders(self) -> Dict[str, Dict]:
+        return await self._run(lambda conn: {
+            row[0]: json.loads(row[1])
+            for row in conn.execute(
+                "SELECT order_id, data FROM orders WHERE status = 'pending' UNION ALL "
+                "SELECT order_id, data FROM orders WHERE status != 'pending' AND json_extract(data, '$.outbox') IS NOT NULL"
+            )
+        })
+
+    async def all_orders(self) -> Dict[str, Dict]:
+        return await self._run(lambda conn: {
+            row[0]: json.loads(row[1])
+            for row in conn.execute("SELECT order_id, data FROM orders ORDER BY timestamp")
+        })
+
+    async def put_orders(self, records: List[tuple]):
+        def apply(conn):
+            conn.executemany(
+                "DELETE FROM orders WHERE order_id = ?",
+                [(oid,) for oid, order in records if order is None],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO orders (order_id, user_id, status, timestamp, data) VALUES (?, ?, ?, ?, ?)",
+                [self._order_row(oid, order) for oid, order in records if order is not None],
+            )
+        await self._run(apply)
+
+    async def replace_orders(self, all_orders: Dict[str, Dict]):
+        def replace(conn):
+            conn.execute("DELETE FROM orders")
+            conn.executemany(
+                "INSERT INTO orders (order_id, user_id, status, timestamp, data) VALUES (?, ?, ?, ?, ?)",
+                [self._order_row(oid, order) for oid, order in all_orders.items()],
+            )
+        await self._run(replace)
+
+    async def compact_orders(self, all_orders: Dict[str, Dict]):
+        await self._run(lambda conn: conn.execute("PRAGMA wal_checkpoint(PASSIVE)"))
+
+    def iter_orders(self, filters: Dict):
+        """Yield (order_id, order) matching filters from a separate read-only connection; call from a worker thread."""
+        clauses, params = [], []
+        for key, clause in (('status', "status = ?"), ('user_id', "user_id = ?"),
+                            ('since', "timestamp >= ?"), ('until', "timestamp < ?")):
+            if key in filters:
+                clauses.append(clause)
+                params.append(filters[key])
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            for order_id, data in conn.execute(f"SELECT order_id, data FROM orders{where} ORDER BY timestamp", params):
+                order = json.loads(data)
+                if order_matches(order, filters):
+                    yield order_id, order
+        finally:
+            conn.close()
+
+    async def get_order(self, order_id: str) -> Optional[Dict]:
+        def fetch(conn):
+            row = conn.execute("SELECT data FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+            return json.loads(row[0]) if row else None
+        return await self._run(fetch)
+
+    async def order_summaries(self) -> List[tuple]:
+        return await self._run(lambda conn: [
+            (row[0], row[1], f"{row[2]} - {row[3]}" if row[2] is not None else None, row[4])
+            for row in conn.execute(
+                "SELECT status, timestamp, json_extract(data, '$.config_snapshot.volume'), "
+                "json_extract(data, '$.config_snapshot.duration'), json_extract(data, '$.config_snapshot.price') FROM orders"
+            )
+        ])
+
+    async def backup_paths(self, tmp_dir: str) -> List[str]:
+        dst_path = os.path.join(tmp_dir, os.path.basename(self.path))
+
+        def copy_db(conn):
+            dst = sqlite3.connect(dst_path)
+            try:
+                conn.backup(dst)
+            finally:
+                dst.close()
+        await self._run(copy_db)
+        return [dst_path]
+
+    def close(self):
+        with self._db_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+def create_storage() -> StorageBackend:
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage()
+    if STORAGE_BACKEND != "file":
+        logger.warning(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}, falling back to file storage")
+    return FileStorage()
+
+storage: StorageBackend = create_storage()
+
+# Inventory Index
+def group_key(cfg: Dict) -> str:
+    return f"{cfg['volume']} - {cfg['duration']}"
+
+class InventoryIndex:
+    """Available config IDs per "volume - duration" group, kept in sync with configs.
+
+    Each group also gets a short ID for compact callback data. The ID is a
+    hash of the group key, so buttons in old messages keep working across
+    restarts and regardless of the order configs are loaded in.
+    """
+
+    def __init__(self):
+        self._groups: Dict[str, "OrderedDict[int, None]"] = {}
+        self._group_of: Dict[int, str] = {}
+        self._prices: Dict[str, Counter] = {}
+        self._price_of: Dict[int, int] = {}
+        self._group_ids: Dict[str, str] = {}
+        self._group_keys: Dict[str, str] = {}
+        self.version = 0
+
+    def rebuild(self, all_configs: Dict[int, Dict]):
+        self._groups = {}
+        self._group_of = {}
+        self._prices = {}
+        self._price_of = {}
+        for cfg in all_configs.values():
+            self.add(cfg)
+        self.version += 1
+
+    def add(self, cfg: Dict):
+        config_id = int(cfg['id'])
+        if config_id in self._group_of:
+            self.discard(config_id)
+        key = group_key(cfg)
+        price = cfg.get('price', 0)
+        self._groups.setdefault(key, OrderedDict())[config_id] = None
+        self._group_of[config_id] = key
+        self._prices.setdefault(key, Counter())[price] += 1
+        self._price_of[config_id] = price
+        if key not in self._group_ids:
+            group_id = self._make_group_id(key)
+            self._group_ids[key] = group_id
+            self._group_keys[group_id] = key
+        self.version += 1
+
+    def _make_group_id(self, key: str) -> str:
+        group_id = hashlib.blake2s(key.encode("utf-8"), digest_size=4).hexdigest()
+        if self._group_keys.get(group_id, key) != key:
+            # برخورد بسیار نادر است؛ شناسه بلندتر همچنان از روی کلید ساخته می‌شود
+            logger.warning(f"Group id collision between {key!r} and {self._group_keys[group_id]!r}")
+            group_id = hashlib.blake2s(key.encode("utf-8"), digest_size=16).hexdigest()
+        return group_id
+
+    def discard(self, config_id: int):
+        key = self._group_of.pop(config_id, None)
+        if key is None:
+            return
+        group = self._groups[key]
+        group.pop(config_id, None)
+        prices = self._prices[key]
+        price = self._price_of.pop(config_id)
+        prices[price] -= 1
+        if prices[price] <= 0:
+            del prices[price]
+        if not group:
+            del self._groups[key]
+            del self._prices[key]
+        self.version += 1
+
+    def __len__(self) -> int:
+        return len(self._group_of)
+
+    def count(self, key: str) -> int:
+        group = self._groups.get(key)
+        return len(group) if group else 0
+
+    def groups(self) -> List[tuple]:
+        """(group key, available count) pairs, cheapest first and fuller groups first at equal price."""
+        return sorted(
+            ((key, len(group)) for key, group in self._groups.items()),
+            key=lambda item: (min(self._prices[item[0]]), -item[1], item[0]),
+        )
+
+    def price_range(self, key: str) -> Optional[tuple]:
+        prices = self._prices.get(key)
+        return (min(prices), max(prices)) if prices else None
+
+    def group_id(self, key: str) -> Optional[str]:
+        return self._group_ids.get(key)
+
+    def group_key_of(self, group_id: str) -> Optional[str]:
+        return self._group_keys.get(group_id)
+
+    def config_ids(self, key: str, offset: int = 0, limit: Optional[int] = None) -> List[int]:
+        group = self._groups.get(key, ())
+        stop = None if limit is None else offset + limit
+        return list(itertools.islice(group, offset, stop))
+
+    def next_available(self, key: str) -> Optional[int]:
+        group = self._groups.get(key)
+        return next(iter(group)) if group else None
+
+inventory = InventoryIndex()
+
+# Order Statistics
+def order_summary(order: Dict) -> tuple:
+    """(status, timestamp, group key, price) — everything the stats counters need from an order."""
+    cfg = order.get('config_snapshot') or {}
+    group = group_key(cfg) if 'volume' in cfg and 'duration' in cfg else None
+    return (order.get('status'), order.get('timestamp'), group, cfg.get('price'))
+
+class OrderStats:
+    """Order counters updated on every state change, so stats never rescan history."""
+
+    ROLLING_HOURS = 24 * 7
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.total = 0
+        self.by_status: Counter = Counter()
+        self.by_group: Counter = Counter()
+        self.revenue_by_day: Dict[str, int] = defaultdict(int)
+        self.by_hour_of_day: List[int] = [0] * 24
+        # hour bucket (epoch hours) -> [orders, approved, revenue]
+        self.hourly: Dict[int, List[int]] = {}
+
+    @staticmethod
+    def _parse(timestamp: Optional[str]) -> datetime:
+        try:
+            return datetime.fromisoformat(timestamp)
+        except (TypeError, ValueError):
+            return datetime.now()
+
+    @staticmethod
+    def _price(price) -> int:
+        try:
+            return int(price)
+        except (TypeError, ValueError):
+            return 0
+
+    def _bucket(self, created: datetime) -> Optional[List[int]]:
+        hour = int(created.timestamp() // 3600)
+        now_hour = int(time.time() // 3600)
+        if hour <= now_hour - self.ROLLING_HOURS:
+            return None
+        bucket = self.hourly.get(hour)
+        if bucket is None:
+            bucket = self.hourly[hour] = [0, 0, 0]
+            if len(self.hourly) > self.ROLLING_HOURS + 1:
+                for old in [h for h in self.hourly if h <= now_hour - self.ROLLING_HOURS]:
+                    del self.hourly[old]
+        return bucket
+
+    def _count_approval(self, created: datetime, price, sign: int):
+        amount = self._price(price) * sign
+        self.revenue_by_day[created.date().isoformat()] += amount
+        bucket = self._bucket(created)
+        if bucket is not None:
+            bucket[1] += sign
+            bucket[2] += amount
+
+    def rebuild(self, summaries):
+        self.reset()
+        for summary in summaries:
+            self.on_create(summary)
+
+    def on_create(self, summary: tuple):
+        status, timestamp, group, price = summary
+        created = self._parse(timestamp)
+        self.total += 1
+        self.by_status[status] += 1
+        if group:
+            self.by_group[group] += 1
+        self.by_hour_of_day[created.hour] += 1
+        bucket = self._bucket(created)
+        if bucket is not None:
+            bucket[0] += 1
+        if status == 'approved':
+            self._count_approval(created, price, 1)
+
+    def on_transition(self, summary: tuple, old_status: Optional[str]):
+        status, timestamp, _, price = summary
+        if status == old_status:
+            return
+        self.by_status[old_status] -= 1
+        self.by_status[status] += 1
+        if status == 'approved':
+            self._count_approval(self._parse(timestamp), price, 1)
+        elif old_status == 'approved':
+            self._count_approval(self._parse(timestamp), price, -1)
+
+    def rolling(self, hours: int) -> Dict[str, int]:
+        """Orders, approvals and revenue of orders created in the last `hours` hours."""
+        now_hour = int(time.time() // 3600)
+        totals = [0, 0, 0]
+        for hour in range(now_hour - min(hours, self.ROLLING_HOURS) + 1, now_hour + 1):
+            bucket = self.hourly.get(hour)
+            if bucket:
+                totals = [a + b for a, b in zip(totals, bucket)]
+        return {'orders': totals[0], 'approved': totals[1], 'revenue': totals[2]}
+
+order_stats = OrderStats()
+
+# Notification Outbox
+class NotificationOutbox:
+    """Customer notifications stored in their order record until Telegram accepts them.
+
+    The entry is written with the same journal record as the status change,
+    so a crash between the state change and the send cannot lose it; a
+    repeating job redelivers whatever is still staged.
+    """
+
+    def __init__(self):
+        self._pending: Set[str] = set()
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self._bot = None
+
+    def attach(self, bot, job_queue):
+        self._bot = bot
+        job_queue.run_repeating(self._redeliver, interval=OUTBOX_RETRY_INTERVAL, first=5, name="outbox_redelivery")
+
+    def rebuild(self, all_orders: Dict[str, Dict]):
+        self._pending = {oid for oid, order in all_orders.items() if order.get('outbox')}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    @staticmethod
+    def _text(order_id: str, order: Dict) -> str:
+        if order['status'] == 'approved':
+            return approval_text(order_id, (order.get('config_snapshot') or {}).get('link', ''))
+        if order['status'] == 'expired':
+            return f"⌛ مهلت پرداخت سفارش `{md_escape(order_id)}` به پایان رسید و سفارش لغو شد\\."
+        return rejection_text(order_id)
+
+    def stage(self, order_id: str, order: Dict):
+        """Attach the customer message for the order's new status; the caller holds the order lock and saves."""
+        order['outbox'] = {'text': self._text(order_id, order), 'parse_mode': 'MarkdownV2'}
+        self._pending.add(order_id)
+
+    def unstage(self, order_id: str, order: Dict):
+        order.pop('outbox', None)
+        self._pending.discard(order_id)
+
+    def dispatch(self, order_id: str) -> asyncio.Task:
+        """Start delivering a staged notification; the task fails if delivery does."""
+        task = self._in_flight.get(order_id)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._deliver(order_id))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._in_flight[order_id] = task
+        return task
+
+    async def _acknowledge(self, order_id: str, order: Dict, error: Optional[str] = None):
+        async with order_locks(order_id):
+            order.pop('outbox', None)
+            if error:
+                order['outbox_error'] = error
+            await DataManager.save_order(order_id)
+        self._pending.discard(order_id)
+
+    async def _deliver(self, order_id: str):
+        try:
+            order = orders.get(order_id)
+            entry = order.get('outbox') if order else None
+            if not entry:
+                self._pending.discard(order_id)
+                return
+            try:
+                await outbound.send(
+                    self._bot.send_message,
+                    chat_id=order['user_id'],
+                    text=entry['text'],
+                    parse_mode=entry.get('parse_mode'),
+                )
+            except (Forbidden, BadRequest) as e:
+                # کاربر ربات را مسدود کرده یا پیام نامعتبر است؛ تلاش دوباره فایده ندارد
+                await self._acknowledge(order_id, order, error=str(e))
+                raise
+            await self._acknowledge(order_id, order)
+        finally:
+            self._in_flight.pop(order_id, None)
+
+    async def _redeliver(self, context: ContextTypes.DEFAULT_TYPE):
+        for order_id in list(self._pending):
+            self.dispatch(order_id)
+
+notification_outbox = NotificationOutbox()
+
+# Pending Orders Index
+def order_sort_key(order_id: str, order: Dict) -> tuple:
+    try:
+        ts = int(datetime.fromisoformat(order['timestamp']).timestamp() * 1_000_000)
+    except (KeyError, TypeError, ValueError):
+        ts = 0
+    return (ts, order_id)
+
+def to_base36(n: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+        if not n:
+            return out
+
+class PendingIndex:
+    """Pending orders sorted by (timestamp, order_id), updated on every status transition."""
+
+    def __init__(self):
+        self._keys: List[tuple] = []
+        self._key_of: Dict[str, tuple] = {}
+
+    def rebuild(self, all_orders: Dict[str, Dict]):
+        self._key_of = {
+            oid: order_sort_key(oid, o) for oid, o in all_orders.items() if o.get('status') == 'pending'
+        }
+        self._keys = sorted(self._key_of.values())
+
+    def add(self, order_id: str, order: Dict):
+        if order_id in self._key_of:
+            return
+        key = order_sort_key(order_id, order)
+        self._key_of[order_id] = key
+        bisect.insort(self._keys, key)
+
+    def discard(self, order_id: str):
+        key = self._key_of.pop(order_id, None)
+        if key is None:
+            return
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            del self._keys[i]
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def order_ids(self) -> List[str]:
+        return [key[1] for key in self._keys]
+
+    @staticmethod
+    def encode_cursor(direction: str, key: tuple) -> str:
+        return f"{direction}{to_base36(key[0])}_{key[1]}"
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> Optional[tuple]:
+        try:
+            direction, rest = cursor[0], cursor[1:]
+            ts, order_id = rest.split("_", 1)
+            if direction not in ("o", "n"):
+                return None
+            return direction, (int(ts, 36), order_id)
+        except (IndexError, ValueError):
+            return None
+
+    def page(self, cursor: Optional[str], size: int) -> tuple:
+        """Return (order IDs newest first, newer cursor, older cursor, page number)."""
+        decoded = self.decode_cursor(cursor) if cursor else None
+        total = len(self._keys)
+        if decoded is None:
+            end = total
+        elif decoded[0] == "o":
+            # صفحه قدیمی‌تر: سفارش‌های قبل از آخرین مورد صفحه فعلی
+            end = bisect.bisect_left(self._keys, decoded[1])
+        else:
+            end = min(total, bisect.bisect_right(self._keys, decoded[1]) + size)
+        start = max(0, end - size)
+        keys = self._keys[start:end]
+        newer = self.encode_cursor("n", keys[-1]) if keys and end < total else None
+        older = self.encode_cursor("o", keys[0]) if keys and start > 0 else None
+        page_no = (total - end) // size + 1
+        return [key[1] for key in reversed(keys)], newer, older, page_no
+
+pending_index = PendingIndex()
+
+# Buffered user registration
+class UserRegistrar:
+    """Collects newly seen user IDs and appends them to storage in batches.
+
+    users_cache is updated immediately; at most USER_FLUSH_INTERVAL seconds
+    of registrations can be lost on a crash. An interval of 0 writes every
+    registration straight away.
+    """
+
+    def __init__(self, interval: float, batch_size: int):
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self._buffer: List[int] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def pending(self) -> Set[int]:
+        return set(self._buffer)
+
+    def add(self, user_id: int):
+        self._buffer.append(user_id)
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with users_lock:
+            if not self._buffer:
+                return
+            batch, self._buffer = self._buffer, []
+            try:
+                await storage.add_users(batch)
+            except Exception:
+                self._buffer[:0] = batch
+                raise
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing {len(self._buffer)} new users: {e}")
+
+user_registrar = UserRegistrar(USER_FLUSH_INTERVAL, USER_FLUSH_BATCH)
+
+# Order Export
+ORDER_EXPORT_FIELDS = ['order_id', 'user_id', 'username', 'config_id', 'group', 'status', 'timestamp']
+
+def parse_export_filters(args: List[str]) -> tuple:
+    """Parse `key=value` command arguments into (filters, gzip).
+
+    Keys: status, from, to (YYYY-MM-DD, inclusive), user, group (quote values with spaces).
+    """
+    filters: Dict[str, object] = {}
+    compress = False
+    for arg in shlex.split(" ".join(args)):
+        if arg.lower() in ("gz", "gzip"):
+            compress = True
+            continue
+        key, sep, value = arg.partition("=")
+        if not sep or not value:
+            raise ValueError(arg)
+        key = key.lower()
+        if key == "status":
+            filters['status'] = value
+        elif key == "from":
+            filters['since'] = datetime.fromisoformat(value).isoformat()
+        elif key == "to":
+            filters['until'] = (datetime.fromisoformat(value) + timedelta(days=1)).isoformat()
+        elif key == "user":
+            filters['user_id'] = int(value)
+        elif key == "group":
+            filters['group'] = value
+        else:
+            raise ValueError(arg)
+    return filters, compress
+
+def order_matches(order: Dict, filters: Dict) -> bool:
+    if 'status' in filters and order.get('status') != filters['status']:
+        return False
+    if 'user_id' in filters and order.get('user_id') != filters['user_id']:
+        return False
+    timestamp = order.get('timestamp') or ''
+    if 'since' in filters and timestamp < filters['since']:
+        return False
+    if 'until' in filters and timestamp >= filters['until']:
+        return False
+    if 'group' in filters and order_summary(order)[2] != filters['group']:
+        return False
+    return True
+
+def write_orders_csv(rows, compress: bool = False):
+    """Write (order_id, order) rows into a spooled temp file; runs in a worker thread."""
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE, mode="w+b")
+    raw = gzip.GzipFile(fileobj=spool, mode="wb") if compress else spool
+    text = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+    writer = csv.DictWriter(text, fieldnames=ORDER_EXPORT_FIELDS)
+    writer.writeheader()
+    for order_id, order in rows:
+        writer.writerow({
+            'order_id': order_id,
+            'user_id': order.get('user_id', ''),
+            'username': csv_safe(order.get('username', '')),
+            'config_id': order.get('config_id', ''),
+            'group': order_summary(order)[2] or '',
+            'status': order.get('status', ''),
+            'timestamp': order.get('timestamp', ''),
+        })
+    text.flush()
+    text.detach()
+    if compress:
+        raw.close()
+    spool.seek(0)
+    return spool
 
 # Data Manager Class
 class DataManager:
@@ -148,127 +1736,245 @@ class DataManager:
         global users_cache
         if not isinstance(user_id, int) or user_id <= 0:
             return len(users_cache)
-        async with users_lock:
-            if user_id not in users_cache:
-                async with aiofiles.open(USERS_FILE, "a", encoding="utf-8") as f:
-                    await f.write(f"{user_id}\n")
-                users_cache.add(user_id)
-            return len(users_cache)
+        if user_id not in users_cache:
+            users_cache.add(user_id)
+            user_registrar.add(user_id)
+            if user_registrar.interval <= 0:
+                await user_registrar.flush()
+        return len(users_cache)
 
     @staticmethod
     async def load_configs():
         global configs, config_id_counter
-        if os.path.exists(CONFIG_FILE):
-            try:
-                async with aiofiles.open(CONFIG_FILE, "r", encoding="utf-8") as f:
-                    content = await f.read()
-                loaded = json.loads(content)
-                configs = {int(cfg["id"]): cfg for cfg in loaded if "id" in cfg}
-                config_id_counter = (max(configs.keys()) + 1) if configs else 1
-            except Exception as e:
-                logger.error(f"Error loading configs: {e}")
-                configs = {}
-                config_id_counter = 1
-        else:
+        try:
+            loaded = await storage.load_configs()
+            configs = {int(cfg["id"]): cfg for cfg in loaded if "id" in cfg}
+            config_id_counter = (max(configs.keys()) + 1) if configs else 1
+        except Exception as e:
+            logger.error(f"Error loading configs: {e}")
             configs = {}
             config_id_counter = 1
+        inventory.rebuild(configs)
+
+    @staticmethod
+    def put_config(cfg: Dict):
+        """Add a new or returned config to stock; the caller must hold its config lock."""
+        configs[cfg['id']] = cfg
+        inventory.add(cfg)
+
+    @staticmethod
+    def take_config(config_id: int) -> Optional[Dict]:
+        """Remove a config from stock; the caller must hold its config lock."""
+        cfg = configs.pop(config_id, None)
+        if cfg is not None:
+            inventory.discard(config_id)
+        return cfg
+
+    @staticmethod
+    async def add_configs(new_configs: List[Dict]):
+        """Assign IDs to a batch of new configs, stock them and persist them in one write."""
+        global config_id_counter
+        async with state_gate.shared():
+            for cfg in new_configs:
+                cfg['id'] = config_id_counter
+                config_id_counter += 1
+                DataManager.put_config(cfg)
+            try:
+                await DataManager.save_configs(changed=new_configs)
+            except Exception:
+                for cfg in new_configs:
+                    DataManager.take_config(cfg['id'])
+                raise
 
     @staticmethod
-    async def save_configs():
-        async with configs_lock:
-            await atomic_write(CONFIG_FILE, json.dumps(list(configs.values()), ensure_ascii=False, indent=2))
+    async def save_configs(changed: Optional[List[Dict]] = None, removed: Optional[List[int]] = None):
+        """Persist config changes; the caller must hold the locks of the changed config IDs."""
+        await storage.save_configs(configs, changed or [], removed or [])
 
     @staticmethod
     async def load_orders():
         global orders
-        if os.path.exists(ORDERS_FILE):
-            try:
-                async with aiofiles.open(ORDERS_FILE, "r", encoding="utf-8") as f:
-                    content = await f.read()
-                orders = json.loads(content)
-                for order_id, order in orders.items():
-                    if "timestamp" not in order:
-                        orders[order_id]["timestamp"] = datetime.now().isoformat()
-            except Exception as e:
-                logger.error(f"Error loading orders: {e}")
-                orders = {}
-        else:
+        try:
+            orders = await storage.load_orders()
+        except Exception as e:
+            logger.error(f"Error loading orders: {e}")
             orders = {}
+        for order_id, order in orders.items():
+            if "timestamp" not in order:
+                orders[order_id]["timestamp"] = datetime.now().isoformat()
+        pending_index.rebuild(orders)
+        notification_outbox.rebuild(orders)
+        try:
+            if storage.keeps_history_in_memory:
+                order_stats.rebuild(order_summary(o) for o in orders.values())
+            else:
+                order_stats.rebuild(await storage.order_summaries())
+        except Exception as e:
+            logger.error(f"Error rebuilding order stats: {e}")
+
+    @staticmethod
+    def add_order(order_id: str, order: Dict):
+        orders[order_id] = order
+        if order.get('status') == 'pending':
+            pending_index.add(order_id, order)
+        order_stats.on_create(order_summary(order))
+
+    @staticmethod
+    def set_status(order_id: str, status: str) -> str:
+        """Move an in-memory order to a new status and keep the indexes in step; returns the old status."""
+        order = orders[order_id]
+        old_status = order.get('status')
+        order['status'] = status
+        if status == 'pending':
+            pending_index.add(order_id, order)
+        else:
+            pending_index.discard(order_id)
+        order_stats.on_transition(order_summary(order), old_status)
+        return old_status
+
+    @staticmethod
+    async def save_order(*order_ids: str):
+        """Persist the in-memory state of the given orders as one write.
+
+        IDs that are no longer in memory are skipped rather than deleted;
+        removing a stored order takes an explicit remove_orders call.
+        """
+        missing = [order_id for order_id in order_ids if order_id not in orders]
+        if missing:
+            logger.warning(f"Not saving orders missing from memory: {', '.join(missing)}")
+        await DataManager.put_orders([(order_id, orders[order_id]) for order_id in order_ids if order_id in orders])
+
+    @staticmethod
+    async def put_orders(records: List[tuple]):
+        """Persist explicit (order_id, order) pairs, e.g. a copy fetched with get_order."""
+        if not records:
+            return
+        if any(order is None for _, order in records):
+            raise ValueError("put_orders cannot delete orders; use remove_orders")
+        await storage.put_orders(records)
+        backup_tracker.mark(order_id for order_id, _ in records)
+        if not storage.keeps_history_in_memory:
+            # سفارش‌های بسته‌شده فقط در دیتابیس نگه داشته می‌شوند
+            for order_id, order in records:
+                if order.get('status') != 'pending' and not order.get('outbox'):
+                    orders.pop(order_id, None)
+        if storage.needs_compaction():
+            DataManager.schedule_compaction()
+
+    @staticmethod
+    async def remove_orders(*order_ids: str):
+        """Delete orders from memory and storage."""
+        for order_id in order_ids:
+            orders.pop(order_id, None)
+        await storage.put_orders([(order_id, None) for order_id in order_ids])
+        backup_tracker.mark(order_ids)
+
+    @staticmethod
+    def schedule_compaction():
+        global compaction_task
+        if compaction_task is None or compaction_task.done():
+            compaction_task = asyncio.create_task(DataManager.save_orders())
 
     @staticmethod
     async def save_orders():
-        async with orders_lock:
-            await atomic_write(ORDERS_FILE, json.dumps(orders, ensure_ascii=False, indent=2, default=str))
+        async with state_gate.shared():
+            await storage.compact_orders(orders)
+
+    @staticmethod
+    async def get_order(order_id: str) -> Optional[Dict]:
+        order = orders.get(order_id)
+        if order is None and not storage.keeps_history_in_memory:
+            order = await storage.get_order(order_id)
+        return order
+
+    @staticmethod
+    async def all_orders() -> Dict[str, Dict]:
+        if storage.keeps_history_in_memory:
+            return orders
+        return await storage.all_orders()
 
     @staticmethod
     async def load_blacklist():
         global blacklist
-        if os.path.exists(BLACKLIST_FILE):
-            try:
-                async with aiofiles.open(BLACKLIST_FILE, "r", encoding="utf-8") as f:
-                    content = await f.read()
-                lines = [line.strip() for line in content.splitlines() if line.strip()]
-                blacklist = {int(line) for line in lines if line.isdigit()}
-            except Exception as e:
-                logger.error(f"Error loading blacklist: {e}")
-                blacklist = set()
-        else:
-            blacklist = set()
+        try:
+            blacklist = await storage.load_blacklist()
+        except Exception as e:
+            logger.error(f"Error loading blacklist: {e}")
+            blacklist = IntSet()
 
     @staticmethod
     async def save_blacklist():
         async with blacklist_lock:
-            tmp = StringIO()
-            for user_id in sorted(blacklist):
-                tmp.write(f"{user_id}\n")
-            await atomic_write(BLACKLIST_FILE, tmp.getvalue())
+            await storage.save_blacklist(set(blacklist))
 
     @staticmethod
     async def load_users_cache():
         global users_cache
-        if os.path.exists(USERS_FILE):
-            try:
-                async with aiofiles.open(USERS_FILE, "r", encoding="utf-8") as f:
-                    content = await f.read()
-                lines = [line.strip() for line in content.splitlines() if line.strip()]
-                users_cache = {int(line) for line in lines if line.isdigit()}
-            except Exception as e:
-                logger.error(f"Error loading users_cache: {e}")
-                users_cache = set()
-        else:
-            users_cache = set()
+        try:
+            users_cache = await storage.load_users()
+        except Exception as e:
+            logger.error(f"Error loading users_cache: {e}")
+            users_cache = IntSet()
+
+    @staticmethod
+    def install_datasets(configs_list: Optional[List[Dict]] = None, all_orders: Optional[Dict[str, Dict]] = None,
+                         users: Optional[Set[int]] = None, blocked: Optional[Set[int]] = None):
+        """Replace in-memory state and rebuild every index without yielding to the event loop."""
+        global configs, config_id_counter, orders, users_cache, blacklist
+        if configs_list is not None:
+            configs = {int(cfg["id"]): cfg for cfg in configs_list}
+            config_id_counter = (max(configs.keys()) + 1) if configs else 1
+            inventory.rebuild(configs)
+        if all_orders is not None:
+            if storage.keeps_history_in_memory:
+                orders = all_orders
+            else:
+                orders = {oid: o for oid, o in all_orders.items() if o.get('status') == 'pending' or o.get('outbox')}
+            pending_index.rebuild(orders)
+            notification_outbox.rebuild(orders)
+            order_stats.rebuild(order_summary(o) for o in all_orders.values())
+            reservations.track_pending(orders)
+        if users is not None:
+            # کاربرانی که هنوز در بافر ثبت‌نام هستند بعد از بازیابی هم نوشته می‌شوند
+            users_cache = IntSet(users) | user_registrar.pending()
+        if blocked is not None:
+            blacklist = IntSet(blocked)
 
     @staticmethod
     def get_stats() -> str:
-        total_configs = len(configs)
-        total_orders = len(orders)
-        pending_orders = sum(1 for order in orders.values() if order.get('status') == 'pending')
-        return f"📊 آمار:\nکاربران: {len(users_cache)}\nکانفیگ‌ها: {total_configs}\nسفارش‌ها: {total_orders}\nسفارش‌های در انتظار: {pending_orders}"
+        day = order_stats.rolling(24)
+        week = order_stats.rolling(24 * 7)
+        return (
+            f"📊 آمار:\nکاربران: {len(users_cache)}\nکانفیگ‌ها: {len(configs)}\n"
+            f"سفارش‌ها: {order_stats.total}\nسفارش‌های در انتظار: {order_stats.by_status['pending']}\n"
+            f"تأیید شده: {order_stats.by_status['approved']} | رد شده: {order_stats.by_status['rejected']} | "
+            f"منقضی: {order_stats.by_status['expired']}\n\n"
+            f"⏱ ۲۴ ساعت اخیر: {day['orders']} سفارش، {day['approved']} تأیید، {day['revenue']} تومان\n"
+            f"📅 ۷ روز اخیر: {week['orders']} سفارش، {week['approved']} تأیید، {week['revenue']} تومان"
+        )
 
     @staticmethod
-    def group_configs() -> Dict[str, List[Dict]]:
-        grouped: Dict[str, List[Dict]] = {}
-        for config in configs.values():
-            key = f"{config['volume']} - {config['duration']}"
-            grouped.setdefault(key, []).append(config)
-        return grouped
+    def reserve_from_group(key: str) -> Optional[Dict]:
+        """Take the next free config of a group out of stock in one synchronous step."""
+        config_id = inventory.next_available(key)
+        if config_id is None:
+            return None
+        return DataManager.take_config(config_id)
 
     @staticmethod
-    def export_orders_csv() -> bytes:
-        output = StringIO()
-        writer = csv.DictWriter(output, fieldnames=['order_id', 'user_id', 'username', 'config_id', 'status', 'timestamp'])
-        writer.writeheader()
-        for order_id, order in orders.items():
-            row = {
-                'order_id': order_id,
-                'user_id': order.get('user_id', ''),
-                'username': csv_safe(order.get('username', '')),
-                'config_id': order.get('config_id', ''),
-                'status': order.get('status', ''),
-                'timestamp': order.get('timestamp', ''),
-            }
-            writer.writerow(row)
-        return output.getvalue().encode('utf-8')
+    def group_configs(key: str, offset: int = 0, limit: Optional[int] = None) -> List[Dict]:
+        return [configs[config_id] for config_id in inventory.config_ids(key, offset, limit)]
+
+    @staticmethod
+    async def export_orders_csv(filters: Optional[Dict] = None, compress: bool = False):
+        """Stream matching orders into a spooled temp file without blocking the event loop."""
+        filters = filters or {}
+        if storage.keeps_history_in_memory:
+            snapshot = list(orders.items())
+            rows = (item for item in snapshot if order_matches(item[1], filters))
+        else:
+            rows = storage.iter_orders(filters)
+        return await asyncio.to_thread(write_orders_csv, rows, compress)
 
     @staticmethod
     def export_stats_csv() -> bytes:
@@ -277,12 +1983,35 @@ class DataManager:
         writer.writerow(['نوع آمار', 'مقدار'])
         writer.writerow(['کاربران', len(users_cache)])
         writer.writerow(['کانفیگ‌ها', len(configs)])
-        writer.writerow(['سفارش‌ها', len(orders)])
-        writer.writerow(['سفارش‌های در انتظار', sum(1 for o in orders.values() if o.get('status') == 'pending')])
+        writer.writerow(['سفارش‌ها', order_stats.total])
+        writer.writerow(['سفارش‌های در انتظار', order_stats.by_status['pending']])
+        for status, count in sorted(order_stats.by_status.items()):
+            writer.writerow([f'وضعیت {status}', count])
+        for group, count in sorted(order_stats.by_group.items()):
+            writer.writerow([f'گروه {csv_safe(group)}', count])
+        for day, revenue in sorted(order_stats.revenue_by_day.items()):
+            writer.writerow([f'درآمد {day}', revenue])
+        for hour, count in enumerate(order_stats.by_hour_of_day):
+            writer.writerow([f'سفارش‌های ساعت {hour:02d}', count])
+        for hours, label in ((24, '۲۴ ساعت اخیر'), (24 * 7, '۷ روز اخیر')):
+            window = order_stats.rolling(hours)
+            writer.writerow([f'سفارش‌ها ({label})', window['orders']])
+            writer.writerow([f'درآمد ({label})', window['revenue']])
         return output.getvalue().encode('utf-8')
 
+async def migrate_to_sqlite():
+    """Import the existing JSON/TXT files into the SQLite database."""
+    source = FileStorage()
+    target = SQLiteStorage()
+    try:
+        imported = await target.import_from(source)
+        logger.info(f"Migrated {', '.join(imported) or 'nothing'} into {target.path}")
+    finally:
+        target.close()
+
 # Global admins and group_id after check
 ADMINS: List[int] = []
+ADMIN_IDS: Set[int] = frozenset()
 ADMIN_GROUP_ID: int = 0
 
 # Blacklist check decorator
@@ -304,14 +2033,74 @@ def check_blacklist(func):
     return wrapper
 
 # Backup & Restore
-async def create_backup_zip(path_list: List[str]) -> str:
+BACKUP_MANIFEST = "manifest.json"
+BACKUP_DELTA_FILE = "orders.delta.journal"
+
+class BackupTracker:
+    """Remembers which orders changed since the last backup so most backups can be incremental."""
+
+    def __init__(self):
+        self.dirty_orders: Set[str] = set()
+        self.since_full = 0
+        self.last_full: Optional[str] = None
+        # با هر بازیابی عوض می‌شود تا بکاپ‌های نیمه‌کاره قبل از آن زنجیره را ادامه ندهند
+        self.generation = 0
+
+    def mark(self, order_ids):
+        self.dirty_orders.update(order_ids)
+
+    def wants_full(self) -> bool:
+        # بعد از ری‌استارت تغییرات قبلی معلوم نیست، پس اولین بکاپ کامل است
+        return self.last_full is None or self.since_full >= BACKUP_FULL_EVERY - 1
+
+    def take(self) -> Set[str]:
+        taken, self.dirty_orders = self.dirty_orders, set()
+        return taken
+
+    def restore(self, order_ids: Set[str]):
+        self.dirty_orders.update(order_ids)
+
+    def reset(self):
+        """Start a new chain after a restore; the next backup is full."""
+        self.dirty_orders = set()
+        self.since_full = 0
+        self.last_full = None
+        self.generation += 1
+
+    def completed(self, name: str, full: bool, generation: int):
+        if generation != self.generation:
+            return
+        if full:
+            self.last_full = name
+            self.since_full = 0
+        else:
+            self.since_full += 1
+
+backup_tracker = BackupTracker()
+
+def _write_backup_zip(zip_path: str, path_list: List[str], extra: Dict[str, object], delta: Optional[List[tuple]]):
+    """Build the archive in a worker thread; files are streamed into the zip in chunks."""
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for p in path_list:
+            if os.path.exists(p):
+                zf.write(p, arcname=os.path.basename(p))
+        for name, payload in extra.items():
+            with zf.open(name, 'w') as out:
+                if isinstance(payload, IntSet):
+                    for user_id in payload:
+                        out.write(f"{user_id}\n".encode("utf-8"))
+                else:
+                    out.write(json.dumps(payload, ensure_ascii=False, indent=2, default=str).encode("utf-8"))
+        if delta is not None:
+            with zf.open(BACKUP_DELTA_FILE, 'w') as out:
+                for order_id, order in delta:
+                    out.write((compact_json({"id": order_id, "order": order}) + "\n").encode("utf-8"))
+
+async def create_backup_zip(path_list: List[str], extra: Dict[str, object] = None, delta: Optional[List[tuple]] = None) -> str:
     tmp_dir = tempfile.mkdtemp()
     zip_path = os.path.join(tmp_dir, f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip")
     try:
-        with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
-            for p in path_list:
-                if os.path.exists(p):
-                    zf.write(p, arcname=os.path.basename(p))
+        await asyncio.to_thread(_write_backup_zip, zip_path, path_list, extra or {}, delta)
         return zip_path
     except Exception:
         if os.path.exists(zip_path):
@@ -319,24 +2108,176 @@ async def create_backup_zip(path_list: List[str]) -> str:
         shutil.rmtree(tmp_dir, ignore_errors=True)
         raise
 
-async def backup_data(context: ContextTypes.DEFAULT_TYPE):
-    path_list = [CONFIG_FILE, ORDERS_FILE, USERS_FILE, BLACKLIST_FILE]
+async def build_backup(snapshot_dir: str, full: bool) -> str:
+    """Full backups copy the storage files; incremental ones carry only orders changed since the last backup."""
+    created = datetime.now().isoformat()
+    changed = backup_tracker.take()
+    if full:
+        try:
+            path_list = await storage.backup_paths(snapshot_dir)
+            manifest = {"type": "full", "created": created}
+            return await create_backup_zip(path_list, {BACKUP_MANIFEST: manifest})
+        except Exception:
+            backup_tracker.restore(changed)
+            raise
+
+    try:
+        # سفارش‌ها روی حلقه کپی می‌شوند تا نوشتن zip در ترد با تغییرات همزمان تداخل نکند
+        delta = [(order_id, copy.deepcopy(await DataManager.get_order(order_id))) for order_id in sorted(changed)]
+        manifest = {"type": "incremental", "created": created, "base": backup_tracker.last_full, "orders": len(delta)}
+        # کانفیگ‌ها و لیست کاربران کوچک‌اند و کامل در بکاپ افزایشی هم می‌آیند
+        extra = {
+            BACKUP_MANIFEST: manifest,
+            CONFIG_FILE: list(configs.values()),
+            USERS_FILE: users_cache.copy(),
+            BLACKLIST_FILE: blacklist.copy(),
+        }
+        return await create_backup_zip([], extra, delta)
+    except Exception:
+        backup_tracker.restore(changed)
+        raise
+
+def _read_id_lines(path: str) -> IntSet:
+    ids = IntSet()
+    with open(path, "rb") as f:
+        ids.update(int(token) for token in f.read().split() if token.isdigit())
+    return ids
+
+def read_backup(zip_path: str, extract_dir: str) -> Dict[str, object]:
+    """Extract and parse a backup archive; runs in a worker thread and touches no live state."""
+    with zipfile.ZipFile(zip_path, 'r') as zf:
+        for member in zf.namelist():
+            if os.path.isabs(member) or ".." in member:
+                continue
+            zf.extract(member, extract_dir)
+
+    def path(name: str) -> str:
+        return os.path.join(extract_dir, name)
+
+    datasets: Dict[str, object] = {}
+    db_path = path(os.path.basename(SQLITE_FILE))
+    if os.path.exists(db_path):
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            datasets["configs"] = [json.loads(row[0]) for row in conn.execute("SELECT data FROM configs ORDER BY id")]
+            datasets["orders"] = {row[0]: json.loads(row[1]) for row in conn.execute("SELECT order_id, data FROM orders")}
+            datasets["users"] = {row[0] for row in conn.execute("SELECT user_id FROM users")}
+            datasets["blacklist"] = {row[0] for row in conn.execute("SELECT user_id FROM blacklist")}
+        finally:
+            conn.close()
+    else:
+        if os.path.exists(path(CONFIG_FILE)):
+            with open(path(CONFIG_FILE), "r", encoding="utf-8") as f:
+                datasets["configs"] = json.load(f)
+        if os.path.exists(path(ORDERS_FILE)) or os.path.exists(path(ORDERS_JOURNAL_FILE)):
+            loaded: Dict[str, Dict] = {}
+            if os.path.exists(path(ORDERS_FILE)):
+                with open(path(ORDERS_FILE), "r", encoding="utf-8") as f:
+                    loaded = json.load(f)
+            if os.path.exists(path(ORDERS_JOURNAL_FILE)):
+                FileStorage._replay_journal(path(ORDERS_JOURNAL_FILE), loaded)
+            datasets["orders"] = loaded
+        if os.path.exists(path(USERS_FILE)):
+            datasets["users"] = _read_id_lines(path(USERS_FILE))
+        if os.path.exists(path(BLACKLIST_FILE)):
+            datasets["blacklist"] = _read_id_lines(path(BLACKLIST_FILE))
+        if os.path.exists(path(BACKUP_DELTA_FILE)):
+            with open(path(BACKUP_DELTA_FILE), "r", encoding="utf-8") as f:
+                datasets["delta"] = {r["id"]: r.get("order") for r in map(json.loads, filter(str.strip, f))}
+    validate_backup(datasets)
+    return datasets
+
+def validate_backup(datasets: Dict[str, object]):
+    """Reject archives whose datasets would break the in-memory indexes."""
+    if not datasets:
+        raise ValueError("هیچ داده‌ای در فایل بکاپ پیدا نشد")
+    seen = set()
+    for cfg in datasets.get("configs", []):
+        if not isinstance(cfg, dict) or not all(k in cfg for k in ("id", "volume", "duration", "price", "link")):
+            raise ValueError(f"کانفیگ نامعتبر: {str(cfg)[:80]}")
+        cfg["id"] = int(cfg["id"])
+        if cfg["id"] in seen:
+            raise ValueError(f"شناسه تکراری کانفیگ: {cfg['id']}")
+        seen.add(cfg["id"])
+    for source in ("orders", "delta"):
+        for order_id, order in (datasets.get(source) or {}).items():
+            if order is None and source == "delta":
+                continue
+            if not isinstance(order, dict) or "user_id" not in order or "status" not in order:
+                raise ValueError(f"سفارش نامعتبر: {order_id}")
+            order.setdefault("timestamp", datetime.now().isoformat())
+
+async def restore_datasets(datasets: Dict[str, object]) -> List[str]:
+    """Write validated datasets to storage, then swap the in-memory state in one synchronous step."""
+    restored = []
+    async with state_gate.exclusive(), users_lock, blacklist_lock:
+        if "configs" in datasets:
+            await storage.replace_configs(datasets["configs"])
+            restored.append("configs")
+        if "orders" in datasets:
+            all_orders = datasets["orders"]
+            await storage.replace_orders(all_orders)
+            restored.append("orders")
+        elif "delta" in datasets:
+            # بکاپ افزایشی روی داده‌های فعلی اعمال می‌شود
+            delta = datasets["delta"]
+            await storage.put_orders(list(delta.items()))
+            all_orders = dict(await DataManager.all_orders())
+            for order_id, order in delta.items():
+                if order is None:
+                    all_orders.pop(order_id, None)
+                else:
+                    all_orders[order_id] = order
+            restored.append(f"orders (+{len(delta)})")
+        else:
+            all_orders = None
+        if "users" in datasets:
+            await storage.replace_users(datasets["users"])
+            restored.append("users")
+        if "blacklist" in datasets:
+            await storage.save_blacklist(datasets["blacklist"])
+            restored.append("blacklist")
+        # از اینجا تا انتها await نیست؛ هندلرها یا وضعیت قبلی را می‌بینند یا وضعیت کامل جدید را
+        DataManager.install_datasets(
+            configs_list=datasets.get("configs"),
+            all_orders=all_orders,
+            users=datasets.get("users"),
+            blocked=datasets.get("blacklist"),
+        )
+        # بکاپ‌های افزایشی قبلی پایه‌ای برای داده‌های بازیابی‌شده نیستند
+        backup_tracker.reset()
+    return restored
+
+async def backup_data(context: ContextTypes.DEFAULT_TYPE, full: Optional[bool] = None):
+    if full is None:
+        full = backup_tracker.wants_full()
+    generation = backup_tracker.generation
+    snapshot_dir = tempfile.mkdtemp()
     try:
-        zip_path = await create_backup_zip(path_list)
+        zip_path = await build_backup(snapshot_dir, full)
     except Exception as e:
         logger.error(f"Failed to create backup zip: {e}", exc_info=True)
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
         return
+    backup_tracker.completed(os.path.basename(zip_path), full, generation)
 
+    kind = "کامل" if full else "افزایشی"
+    caption = f"📦 بکاپ {kind} داده‌ها — نگهدارید تا در زمان دیپلوی بعدی استفاده کنید."
     try:
+        # فایل فقط یک بار آپلود می‌شود و برای بقیه ادمین‌ها با file_id ارسال می‌شود
+        file_id = None
         for admin in ADMINS:
             try:
-                with open(zip_path, "rb") as fh:
-                    await context.bot.send_document(
-                        chat_id=admin,
-                        document=fh,
-                        filename=os.path.basename(zip_path),
-                        caption="📦 بکاپ داده‌ها — نگهدارید تا در زمان دیپلوی بعدی استفاده کنید."
-                    )
+                message = await outbound.send(
+                    context.bot.send_document,
+                    chat_id=admin,
+                    priority=OutboundDispatcher.PRIORITY_BACKGROUND,
+                    document=file_id or Path(zip_path),
+                    filename=os.path.basename(zip_path),
+                    caption=caption,
+                )
+                if file_id is None and message and message.document:
+                    file_id = message.document.file_id
             except Exception as e:
                 logger.error(f"Error sending backup to admin {admin}: {e}")
     finally:
@@ -346,14 +2287,16 @@ async def backup_data(context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             pass
         shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
 
 async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id not in ADMINS:
         await update.message.reply_text("❌ دسترسی ندارید.")
         return
+    full = True if context.args and context.args[0].lower() == "full" else None
     await update.message.reply_text("⏳ در حال تهیه بکاپ و ارسال به ادمین‌ها...")
-    await backup_data(context)
+    await backup_data(context, full=full)
     await update.message.reply_text("✅ بکاپ ارسال شد (درصورت موفقیت به ادمین‌ها).")
 
 async def restore_help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -378,66 +2321,398 @@ async def restore_file_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         return
 
     await update.message.reply_text("⏳ فایل دریافت شد، در حال دانلود و بازیابی...")
+    tmp_dir = tempfile.mkdtemp()
     try:
         file = await doc.get_file()
-        tmp_dir = tempfile.mkdtemp()
-        zip_path = os.path.join(tmp_dir, fname)
+        zip_path = os.path.join(tmp_dir, os.path.basename(fname))
         await file.download_to_drive(zip_path)
 
         extract_dir = os.path.join(tmp_dir, "extracted")
         os.makedirs(extract_dir, exist_ok=True)
-        with zipfile.ZipFile(zip_path, 'r') as zf:
-            for member in zf.namelist():
-                if os.path.isabs(member) or ".." in member:
-                    continue
-                zf.extract(member, extract_dir)
-
-        restored_files = []
-        for base_name in [CONFIG_FILE, ORDERS_FILE, USERS_FILE, BLACKLIST_FILE]:
-            src = os.path.join(extract_dir, base_name)
-            if os.path.exists(src):
-                dst = os.path.join(os.getcwd(), base_name)
-                shutil.copyfile(src, dst)
-                restored_files.append(base_name)
-
-        await DataManager.load_configs()
-        await DataManager.load_orders()
-        await DataManager.load_blacklist()
-        await DataManager.load_users_cache()
-
-        await update.message.reply_text(f"✅ بازیابی انجام شد. فایل‌های بازیابی‌شده: {', '.join(restored_files)}")
+        try:
+            datasets = await asyncio.to_thread(read_backup, zip_path, extract_dir)
+        except (ValueError, KeyError, TypeError, zipfile.BadZipFile, sqlite3.Error) as e:
+            logger.warning(f"Rejected backup {fname}: {e}")
+            await update.message.reply_text(f"❌ فایل بکاپ نامعتبر است و چیزی تغییر نکرد.\n{e}")
+            return
+
+        restored_files = await restore_datasets(datasets)
+        await update.message.reply_text(f"✅ بازیابی انجام شد. داده‌های بازیابی‌شده: {', '.join(restored_files)}")
     except Exception as e:
         logger.error(f"Error restoring backup: {e}", exc_info=True)
         await update.message.reply_text("❌ خطا در بازیابی بکاپ. لاگ بررسی شود.")
     finally:
-        shutil.rmtree(tmp_dir, ignore_errors=True)
+        await asyncio.to_thread(shutil.rmtree, tmp_dir, True)
+
+# Bulk config import
+CONFIG_IMPORT_EXTENSIONS = (".csv", ".txt", ".json", ".jsonl")
+CONFIG_IMPORT_HELP = (
+    "فایل CSV (ستون‌های volume,duration,price,link)، JSON (لیست آبجکت‌ها) یا TXT (هر خط یک لینک) ارسال کنید.\n"
+    "مقادیر پیش‌فرض را می‌توانید در کپشن بنویسید، مثلاً:\n"
+    "volume=20GB duration=30d price=150000"
+)
+
+def parse_import_defaults(caption: str) -> Dict[str, str]:
+    defaults = {}
+    for arg in shlex.split(caption):
+        key, sep, value = arg.partition("=")
+        if not sep or key.lower() not in ("volume", "duration", "price"):
+            raise ValueError(arg)
+        defaults[key.lower()] = value
+    return defaults
+
+def iter_import_rows(path: str, defaults: Dict[str, str]):
+    """Yield (line number, row dict or None) from an import document without loading CSV/TXT/JSONL files whole."""
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if ext == ".json":
+            data = json.load(f)
+            if not isinstance(data, list):
+                raise ValueError("JSON باید یک لیست باشد")
+            for i, item in enumerate(data, 1):
+                if isinstance(item, str):
+                    item = {"link": item}
+                yield i, {**defaults, **item} if isinstance(item, dict) else None
+        elif ext == ".jsonl":
+            for i, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError:
+                    yield i, None
+                    continue
+                yield i, {**defaults, **item} if isinstance(item, dict) else None
+        elif ext == ".csv":
+            reader = csv.DictReader(f)
+            reader.fieldnames = [(name or "").strip().lower() for name in reader.fieldnames or []]
+            for row in reader:
+                yield reader.line_num, {**defaults, **{k: v for k, v in row.items() if k and v}}
+        else:
+            for i, line in enumerate(f, 1):
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    yield i, {**defaults, "link": line}
+
+def validate_import_row(row: Optional[Dict]) -> tuple:
+    """Return (config, None) for a usable row or (None, reason)."""
+    if row is None:
+        return None, "قابل خواندن نیست"
+    volume = str(row.get("volume", "")).strip()
+    duration = str(row.get("duration", "")).strip()
+    if not volume or not duration:
+        return None, "حجم یا مدت ندارد"
+    try:
+        price = int(str(row.get("price", "")).replace(",", "").strip())
+    except ValueError:
+        return None, "قیمت نامعتبر"
+    if price <= 0:
+        return None, "قیمت نامعتبر"
+    link = clean_config_link(str(row.get("link", "")))
+    if not link:
+        return None, "لینک ندارد"
+    return {"volume": volume, "duration": duration, "price": price, "link": link}, None
+
+def parse_config_import(path: str, defaults: Dict[str, str], existing_links: Set[str]) -> Dict[str, object]:
+    """Parse, validate and deduplicate an import document; runs in a worker thread."""
+    accepted: List[Dict] = []
+    duplicates = 0
+    invalid: List[tuple] = []
+    seen = set(existing_links)
+    for line_no, row in iter_import_rows(path, defaults):
+        cfg, reason = validate_import_row(row)
+        if cfg is None:
+            invalid.append((line_no, reason))
+        elif cfg["link"] in seen:
+            duplicates += 1
+        else:
+            seen.add(cfg["link"])
+            accepted.append(cfg)
+    return {"configs": accepted, "duplicates": duplicates, "invalid": invalid}
+
+async def import_configs_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    doc = update.message.document
+    fname = doc.file_name or ""
+    try:
+        defaults = parse_import_defaults(update.message.caption or "")
+    except ValueError:
+        await update.message.reply_text("کپشن نامعتبر است.\n" + CONFIG_IMPORT_HELP)
+        return
+
+    await update.message.reply_text("⏳ فایل کانفیگ‌ها دریافت شد، در حال بررسی...")
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        file = await doc.get_file()
+        path = os.path.join(tmp_dir, os.path.basename(fname))
+        await file.download_to_drive(path)
+        existing_links = {cfg.get('link') for cfg in configs.values()}
+        try:
+            result = await asyncio.to_thread(parse_config_import, path, defaults, existing_links)
+        except (ValueError, UnicodeDecodeError, csv.Error) as e:
+            logger.warning(f"Rejected config import {fname}: {e}")
+            await update.message.reply_text(f"❌ فایل قابل پردازش نیست و چیزی اضافه نشد.\n{e}")
+            return
+
+        # کانفیگ‌هایی که در حین پردازش فایل اضافه شده‌اند هم تکراری حساب می‌شوند
+        current_links = {cfg.get('link') for cfg in configs.values()}
+        new_configs = [cfg for cfg in result["configs"] if cfg["link"] not in current_links]
+        duplicates = result["duplicates"] + len(result["configs"]) - len(new_configs)
+        if new_configs:
+            await DataManager.add_configs(new_configs)
+
+        invalid = result["invalid"]
+        report = (
+            f"📥 نتیجه افزودن کانفیگ‌ها:\n"
+            f"✅ اضافه شد: {len(new_configs)}\n"
+            f"♻️ تکراری: {duplicates}\n"
+            f"⚠️ نامعتبر: {len(invalid)}"
+        )
+        if invalid:
+            report += "\n" + "\n".join(f"خط {line_no}: {reason}" for line_no, reason in invalid[:20])
+            if len(invalid) > 20:
+                report += f"\n... و {len(invalid) - 20} مورد دیگر"
+        await update.message.reply_text(report)
+    except Exception as e:
+        logger.error(f"Error importing configs: {e}", exc_info=True)
+        await update.message.reply_text("❌ خطا در افزودن کانفیگ‌ها. لاگ بررسی شود.")
+    finally:
+        await asyncio.to_thread(shutil.rmtree, tmp_dir, True)
+
+async def document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Route admin documents by extension: ZIP restores a backup, CSV/TXT/JSON imports configs."""
+    if update.effective_user.id not in ADMIN_IDS or not update.message or not update.message.document:
+        return
+    fname = (update.message.document.file_name or "").lower()
+    if fname.endswith(".zip"):
+        await restore_file_handler(update, context)
+    elif fname.endswith(CONFIG_IMPORT_EXTENSIONS):
+        await import_configs_handler(update, context)
+    else:
+        await update.message.reply_text("فایل ZIP برای بازیابی بکاپ یا فایل CSV/TXT/JSON برای افزودن کانفیگ ارسال کنید.")
+
+# Menu render cache
+class RenderCache:
+    """LRU cache of rendered (text, keyboard) pairs keyed by menu id.
+
+    Each entry remembers the version it was built for; menus that list stock
+    pass inventory.version, so any add, removal, purchase or return rebuilds
+    them on the next tap. Static menus use version 0.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max(1, max_entries)
+        self._entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, menu_id, version: int, build) -> tuple:
+        entry = self._entries.get(menu_id)
+        if entry is not None and entry[0] == version:
+            self._entries.move_to_end(menu_id)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        rendered = build()
+        self._entries[menu_id] = (version, rendered)
+        self._entries.move_to_end(menu_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return rendered
+
+    def metrics(self) -> Dict[str, int]:
+        return {"menu_cache_hits": self.hits, "menu_cache_misses": self.misses, "menu_cache_entries": len(self._entries)}
+
+menu_cache = RenderCache(MENU_CACHE_SIZE)
+
+def render_start_menu(is_admin: bool) -> tuple:
+    keyboard = [
+        [InlineKeyboardButton("💳 خرید کانفیگ", callback_data="buy")],
+        [InlineKeyboardButton("📞 تماس با پشتیبانی", callback_data="support")],
+    ]
+    if is_admin:
+        keyboard.append([InlineKeyboardButton("🔧 پنل ادمین", callback_data="admin_panel")])
+    return "سلام 👋\nبه ماناوا خوش آمدید.", InlineKeyboardMarkup(keyboard)
+
+def page_nav_row(prefix: str, page: int, pages: int) -> List[InlineKeyboardButton]:
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"{prefix}{page - 1}"))
+    if pages > 1:
+        row.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="noop"))
+    if page < pages - 1:
+        row.append(InlineKeyboardButton("بعدی ➡️", callback_data=f"{prefix}{page + 1}"))
+    return row
+
+def render_buy_menu(page: int = 0) -> tuple:
+    groups = inventory.groups()
+    pages = max(1, (len(groups) + GROUPS_PER_PAGE - 1) // GROUPS_PER_PAGE)
+    page = min(max(page, 0), pages - 1)
+    keyboard = []
+    for key, count in groups[page * GROUPS_PER_PAGE:(page + 1) * GROUPS_PER_PAGE]:
+        low, _ = inventory.price_range(key)
+        keyboard.append([InlineKeyboardButton(
+            f"{key} | از {low} تومان (موجود: {count})", callback_data=f"bg_{inventory.group_id(key)}"
+        )])
+    nav = page_nav_row("bp_", page, pages)
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("لغو", callback_data="cancel")])
+    return "لطفاً یک گروه کانفیگ انتخاب کنید:", InlineKeyboardMarkup(keyboard)
+
+def render_group_menu(group_id: str, is_admin: bool, page: int = 0) -> Optional[tuple]:
+    key = inventory.group_key_of(group_id)
+    count = inventory.count(key) if key else 0
+    if not count:
+        return None
+    low, high = inventory.price_range(key)
+    price_text = f"{low}" if low == high else f"{low} تا {high}"
+    keyboard = [[InlineKeyboardButton(f"🛒 خرید ({count} موجود)", callback_data=f"bga_{group_id}")]]
+    if is_admin:
+        # ادمین‌ها کانفیگ‌ها را صفحه‌به‌صفحه می‌بینند
+        pages = (count + CONFIGS_PER_PAGE - 1) // CONFIGS_PER_PAGE
+        page = min(max(page, 0), pages - 1)
+        for cfg in DataManager.group_configs(key, page * CONFIGS_PER_PAGE, CONFIGS_PER_PAGE):
+            keyboard.append([InlineKeyboardButton(f"{cfg['volume']} {cfg['duration']} - {cfg['price']} تومان", callback_data=f"bc_{cfg['id']}")])
+        nav = page_nav_row(f"bgp_{group_id}_", page, pages)
+        if nav:
+            keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="buy")])
+    return f"⚙️ {key}\n💰 قیمت: {price_text} تومان", InlineKeyboardMarkup(keyboard)
+
+def render_admin_panel() -> tuple:
+    admin_keyboard = [
+        [InlineKeyboardButton("📊 آمار", callback_data="admin_stats")],
+        [InlineKeyboardButton("📋 لیست سفارش‌ها", callback_data="admin_list_orders")],
+        [InlineKeyboardButton("➕ اضافه کانفیگ", callback_data="admin_add_config")],
+        [InlineKeyboardButton("➖ حذف کانفیگ", callback_data="admin_remove_config")],
+        [InlineKeyboardButton("📤 اکسپورت داده‌ها", callback_data="admin_export")],
+        [InlineKeyboardButton("🚫 Bulk Actions", callback_data="admin_bulk")],
+        [InlineKeyboardButton("❌ بستن", callback_data="admin_close")],
+    ]
+    return "🔧 پنل ادمین:", InlineKeyboardMarkup(admin_keyboard)
+
+def render_export_menu() -> tuple:
+    export_keyboard = [
+        [InlineKeyboardButton("📋 اکسپورت سفارش‌ها", callback_data="export_orders")],
+        [InlineKeyboardButton("📊 اکسپورت آمار", callback_data="export_stats")],
+        [InlineKeyboardButton("🔙 بازگشت", callback_data="admin_panel")],
+    ]
+    return "انتخاب کنید چه چیزی را اکسپورت کنید:", InlineKeyboardMarkup(export_keyboard)
+
+def render_bulk_menu() -> tuple:
+    bulk_keyboard = [
+        [InlineKeyboardButton("✅ تأیید گروهی", callback_data="bulk_approve")],
+        [InlineKeyboardButton("❌ رد گروهی", callback_data="bulk_reject")],
+        [InlineKeyboardButton("🔙 بازگشت", callback_data="admin_panel")],
+    ]
+    return "برای Bulk Actions، IDهای سفارش را با کاما جدا کنید (مثل id1,id2):", InlineKeyboardMarkup(bulk_keyboard)
+
+# Callback routing
+class CallbackRoute:
+    __slots__ = ("name", "handler", "admin_only", "answers")
+
+    def __init__(self, name: str, handler, admin_only: bool, answers: bool):
+        self.name = name
+        self.handler = handler
+        self.admin_only = admin_only
+        # True if the handler answers the callback query itself
+        self.answers = answers
+
+class CallbackRouter:
+    """Dispatches callback data by exact match first, then by the longest registered prefix.
+
+    Prefixes live in a character trie, so lookup cost depends on the length
+    of the callback data (at most 64 bytes), not on the number of routes.
+    """
+
+    SLOW_ROUTE_SECONDS = 1.0
+
+    def __init__(self):
+        self._exact: Dict[str, CallbackRoute] = {}
+        self._trie: Dict = {}
+        self._hooks: List = []
+        self.timings: Dict[str, List[float]] = defaultdict(lambda: [0, 0.0, 0.0])
+
+    def exact(self, data: str, admin_only: bool = False, answers: bool = False):
+        def register(handler):
+            self._exact[data] = CallbackRoute(data, handler, admin_only, answers)
+            return handler
+        return register
+
+    def prefix(self, prefix: str, admin_only: bool = False, answers: bool = False):
+        def register(handler):
+            node = self._trie
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+            node[None] = CallbackRoute(f"{prefix}*", handler, admin_only, answers)
+            return handler
+        return register
+
+    def add_timing_hook(self, hook):
+        """hook(route_name, seconds) is called after every dispatched callback."""
+        self._hooks.append(hook)
+
+    def resolve(self, data: str) -> tuple:
+        """Return (route, argument) or (None, None)."""
+        route = self._exact.get(data)
+        if route is not None:
+            return route, ""
+        node, found = self._trie, None
+        for i, ch in enumerate(data):
+            node = node.get(ch)
+            if node is None:
+                break
+            if None in node:
+                found = (node[None], data[i + 1:])
+        return found or (None, None)
+
+    def _record(self, name: str, elapsed: float):
+        stats = self.timings[name]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+        if elapsed > self.SLOW_ROUTE_SECONDS:
+            logger.warning(f"Slow callback route {name}: {elapsed:.2f}s")
+
+    async def dispatch(self, route: CallbackRoute, query, context, arg: str):
+        started = time.perf_counter()
+        try:
+            return await route.handler(query, context, arg)
+        finally:
+            elapsed = time.perf_counter() - started
+            self._record(route.name, elapsed)
+            for hook in self._hooks:
+                try:
+                    hook(route.name, elapsed)
+                except Exception as e:
+                    logger.error(f"Callback timing hook failed: {e}")
+
+    def metrics(self) -> Dict[str, float]:
+        result = {}
+        for name, (count, total, slowest) in self.timings.items():
+            result[f"callback_{name}_count"] = count
+            result[f"callback_{name}_avg_ms"] = round(total / count * 1000, 2)
+            result[f"callback_{name}_max_ms"] = round(slowest * 1000, 2)
+        return result
+
+callback_router = CallbackRouter()
 
 # Handlers
 @check_blacklist
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if is_rate_limited(user_id):
+    if is_rate_limited(user_id, "start"):
         await update.message.reply_text("⏳ لطفاً کمی صبر کنید.")
         return
     await DataManager.save_user(user_id)
-    keyboard = [
-        [InlineKeyboardButton("💳 خرید کانفیگ", callback_data="buy")],
-        [InlineKeyboardButton("📞 تماس با پشتیبانی", callback_data="support")],
-    ]
-    if user_id in ADMINS:
-        keyboard.append([InlineKeyboardButton("🔧 پنل ادمین", callback_data="admin_panel")])
-    await update.message.reply_text(
-        "سلام 👋\nبه ماناوا خوش آمدید.",
-        reply_markup=InlineKeyboardMarkup(keyboard),
-    )
+    text, keyboard = menu_cache.get(("start", user_id in ADMIN_IDS), 0, lambda: render_start_menu(user_id in ADMIN_IDS))
+    await update.message.reply_text(text, reply_markup=keyboard)
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     user_id = query.from_user.id
 
-    # Rate limit فقط برای غیرادمین‌ها
-    if user_id not in ADMINS and is_rate_limited(user_id):
+    if is_rate_limited(user_id, "callback"):
         await query.answer("⏳ لطفاً کمی صبر کنید.")
         return
 
@@ -445,303 +2720,402 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("⛔ شما مسدود شده‌اید.")
         return
 
-    data = query.data or ""
-
-    if data == "buy":
-        if not configs:
-            await query.edit_message_text("موجودی سرورها تمام شده، جهت ثبت سفارش به پشتیبانی مراجعه کنید.")
-            return
-        grouped = DataManager.group_configs()
-        keyboard = []
-        for key, cfgs in grouped.items():
-            if cfgs:
-                keyboard.append([InlineKeyboardButton(f"{key} (موجود: {len(cfgs)})", callback_data=f"buy_group_{key}")])
-        keyboard.append([InlineKeyboardButton("لغو", callback_data="cancel")])
-        await query.edit_message_text("لطفاً یک گروه کانفیگ انتخاب کنید:", reply_markup=InlineKeyboardMarkup(keyboard))
-
-    elif data.startswith("buy_group_"):
-        key = data[len("buy_group_"):]
-        grouped = DataManager.group_configs()
-        cfgs = grouped.get(key, [])
-        if not cfgs:
-            await query.edit_message_text("کانفیگ یافت نشد.")
-            return
-        keyboard = []
-        for cfg in cfgs:
-            keyboard.append([InlineKeyboardButton(f"{cfg['volume']} {cfg['duration']} - {cfg['price']} تومان", callback_data=f"buy_config_{cfg['id']}")])
-        keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="buy")])
-        await query.edit_message_text("لطفاً یک کانفیگ انتخاب کنید:", reply_markup=InlineKeyboardMarkup(keyboard))
+    route, arg = callback_router.resolve(query.data or "")
+    if route is None:
+        await query.answer()
         return
+    if route.admin_only and user_id not in ADMIN_IDS:
+        await query.answer("❌ دسترسی ندارید.")
+        return
+    if not route.answers:
+        await query.answer()
+    return await callback_router.dispatch(route, query, context, arg)
 
-    elif data == "support":
-        await query.edit_message_text("پشتیبانی: @manava_vpn")
-
-    elif data == "admin_panel":
-        if user_id not in ADMINS:
-            await query.answer("❌ دسترسی ندارید.")
-            return
-        admin_keyboard = [
-            [InlineKeyboardButton("📊 آمار", callback_data="admin_stats")],
-            [InlineKeyboardButton("📋 لیست سفارش‌ها", callback_data="admin_list_orders")],
-            [InlineKeyboardButton("➕ اضافه کانفیگ", callback_data="admin_add_config")],
-            [InlineKeyboardButton("➖ حذف کانفیگ", callback_data="admin_remove_config")],
-            [InlineKeyboardButton("📤 اکسپورت داده‌ها", callback_data="admin_export")],
-            [InlineKeyboardButton("🚫 Bulk Actions", callback_data="admin_bulk")],
-            [InlineKeyboardButton("❌ بستن", callback_data="admin_close")],
-        ]
-        await query.edit_message_text("🔧 پنل ادمین:", reply_markup=InlineKeyboardMarkup(admin_keyboard))
+BACK_TO_ADMIN_PANEL = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data="admin_panel")]])
 
-    elif data == "admin_stats":
-        if user_id not in ADMINS:
-            await query.answer("❌ دسترسی ندارید.")
-            return
-        stats_text = DataManager.get_stats()
-        keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data="admin_panel")]]
-        await query.edit_message_text(stats_text, reply_markup=InlineKeyboardMarkup(keyboard))
+@callback_router.exact("buy")
+@callback_router.prefix("bp_")
+async def buy_menu(query, context, arg: str):
+    if not inventory:
+        await query.edit_message_text("موجودی سرورها تمام شده، جهت ثبت سفارش به پشتیبانی مراجعه کنید.")
+        return
+    page = int(arg) if arg.isdigit() else 0
+    text, keyboard = menu_cache.get(("buy", page), inventory.version, lambda: render_buy_menu(page))
+    await query.edit_message_text(text, reply_markup=keyboard)
+
+async def show_group_menu(query, group_id: Optional[str], page: int = 0):
+    is_admin = query.from_user.id in ADMIN_IDS
+    if not is_admin:
+        page = 0
+    if inventory.group_key_of(group_id) is None:
+        await query.edit_message_text("این دکمه دیگر معتبر نیست، لطفاً دوباره از منوی خرید انتخاب کنید.")
+        return
+    rendered = menu_cache.get(
+        ("group", group_id, is_admin, page), inventory.version,
+        lambda: render_group_menu(group_id, is_admin, page),
+    )
+    if rendered is None:
+        await query.edit_message_text("کانفیگ یافت نشد.")
+        return
+    text, keyboard = rendered
+    await query.edit_message_text(text, reply_markup=keyboard)
 
-    elif data == "admin_list_orders":
-        if user_id not in ADMINS:
-            await query.answer("❌ دسترسی ندارید.")
-            return
-        await show_orders_page(query, context, page=1)
+@callback_router.prefix("bg_")
+async def buy_group_menu(query, context, arg: str):
+    await show_group_menu(query, arg)
 
-    elif data.startswith("orders_page_"):
-        try:
-            page = int(data.split("_")[2])
-        except Exception:
-            page = 1
-        await show_orders_page(query, context, page)
+@callback_router.prefix("bgp_", admin_only=True)
+async def buy_group_page(query, context, arg: str):
+    group_id, _, page = arg.partition("_")
+    if not page.isdigit():
+        return
+    await show_group_menu(query, group_id, int(page))
+
+@callback_router.prefix("buy_group_")
+async def legacy_buy_group_menu(query, context, key: str):
+    # دکمه‌های پیام‌های قدیمی که نام گروه را در callback دارند
+    await show_group_menu(query, inventory.group_id(key))
+
+@callback_router.prefix("bga_")
+async def buy_any_config(query, context, arg: str):
+    key = inventory.group_key_of(arg)
+    if key is None:
+        await query.edit_message_text("این دکمه دیگر معتبر نیست، لطفاً دوباره از منوی خرید انتخاب کنید.")
+        return
+    cfg = DataManager.reserve_from_group(key)
+    if not cfg:
+        await query.edit_message_text("موجودی این گروه تمام شده است.")
+        return
+    await place_order(query, context, cfg)
 
-    elif data.startswith("order_approve_") or data.startswith("order_reject_"):
-        if user_id not in ADMINS:
-            await query.answer("❌ دسترسی ندارید.")
-            return
-        action = "approve" if data.startswith("order_approve_") else "reject"
-        order_id = data.split("_")[2]
-        await process_order_action(query, context, order_id, action)
+@callback_router.prefix("buy_any_")
+async def legacy_buy_any_config(query, context, key: str):
+    await buy_any_config(query, context, inventory.group_id(key) or "")
 
-    elif data == "admin_add_config":
-        if user_id not in ADMINS:
-            await query.answer("❌ دسترسی ندارید.")
-            return
-        keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data="admin_panel")]]
-        await query.edit_message_text(
-            "برای اضافه کانفیگ، از دستور /add_config استفاده کنید.",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+@callback_router.prefix("bc_", admin_only=True)
+@callback_router.prefix("buy_config_", admin_only=True)
+async def buy_specific_config(query, context, arg: str):
+    try:
+        config_id = int(arg)
+    except ValueError:
+        await query.edit_message_text("خطا در انتخاب کانفیگ.")
+        return
+    # قفل‌ها بازگشتی نیستند و place_order خودش دوباره همین قفل را می‌گیرد
+    async with config_locks(config_id):
+        cfg = DataManager.take_config(config_id)
+    if not cfg:
+        await query.edit_message_text("کانفیگ مورد نظر موجود نیست (ممکن است قبلاً خریداری شده باشد).")
+        return
+    await place_order(query, context, cfg)
+
+@callback_router.exact("noop")
+async def ignore_callback(query, context, arg: str):
+    pass
+
+@callback_router.exact("support")
+async def support_info(query, context, arg: str):
+    await query.edit_message_text("پشتیبانی: @manava_vpn")
+
+@callback_router.exact("admin_panel", admin_only=True)
+async def admin_panel_menu(query, context, arg: str):
+    text, keyboard = menu_cache.get("admin_panel", 0, render_admin_panel)
+    await query.edit_message_text(text, reply_markup=keyboard)
+
+@callback_router.exact("admin_stats", admin_only=True)
+async def admin_stats_view(query, context, arg: str):
+    await query.edit_message_text(DataManager.get_stats(), reply_markup=BACK_TO_ADMIN_PANEL)
+
+@callback_router.exact("admin_list_orders", admin_only=True)
+async def admin_list_orders(query, context, arg: str):
+    await show_orders_page(query, context)
+
+@callback_router.prefix("orders_page_", admin_only=True)
+async def admin_orders_page(query, context, cursor: str):
+    await show_orders_page(query, context, cursor)
+
+@callback_router.prefix("order_approve_", admin_only=True, answers=True)
+@callback_router.prefix("approve_", admin_only=True, answers=True)
+async def approve_order(query, context, order_id: str):
+    await process_order_action(query, context, order_id, "approve")
+
+@callback_router.prefix("order_reject_", admin_only=True, answers=True)
+@callback_router.prefix("reject_", admin_only=True, answers=True)
+async def reject_order(query, context, order_id: str):
+    await process_order_action(query, context, order_id, "reject")
+
+@callback_router.exact("admin_add_config", admin_only=True)
+async def admin_add_config_help(query, context, arg: str):
+    await query.edit_message_text(
+        "برای اضافه کانفیگ، از دستور /add_config استفاده کنید.\n\nبرای افزودن گروهی:\n" + CONFIG_IMPORT_HELP,
+        reply_markup=BACK_TO_ADMIN_PANEL,
+    )
 
-    elif data == "admin_remove_config":
-        if user_id not in ADMINS:
-            await query.answer("❌ دسترسی ندارید.")
-            return
-        keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data="admin_panel")]]
-        await query.edit_message_text(
-            "برای حذف کانفیگ، از دستور /remove_config استفاده کنید.",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+@callback_router.exact("admin_remove_config", admin_only=True)
+async def admin_remove_config_help(query, context, arg: str):
+    await query.edit_message_text("برای حذف کانفیگ، از دستور /remove_config استفاده کنید.", reply_markup=BACK_TO_ADMIN_PANEL)
 
-    elif data == "admin_export":
-        if user_id not in ADMINS:
-            await query.answer("❌ دسترسی ندارید.")
-            return
-        export_keyboard = [
-            [InlineKeyboardButton("📋 اکسپورت سفارش‌ها", callback_data="export_orders")],
-            [InlineKeyboardButton("📊 اکسپورت آمار", callback_data="export_stats")],
-            [InlineKeyboardButton("🔙 بازگشت", callback_data="admin_panel")],
-        ]
-        await query.edit_message_text("انتخاب کنید چه چیزی را اکسپورت کنید:", reply_markup=InlineKeyboardMarkup(export_keyboard))
+@callback_router.exact("admin_export", admin_only=True)
+async def admin_export_menu(query, context, arg: str):
+    text, keyboard = menu_cache.get("admin_export", 0, render_export_menu)
+    await query.edit_message_text(text, reply_markup=keyboard)
 
-    elif data == "export_orders":
-        csv_data = DataManager.export_orders_csv()
+@callback_router.exact("export_orders", admin_only=True)
+async def admin_export_orders(query, context, arg: str):
+    export_file = await DataManager.export_orders_csv()
+    with export_file:
         await query.message.reply_document(
-            document=BytesIO(csv_data),
+            document=export_file,
             filename="orders.csv",
             caption="فایل CSV سفارش‌ها",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data="admin_panel")]]),
+            reply_markup=BACK_TO_ADMIN_PANEL,
         )
-        with contextlib.suppress(Exception):
-            await query.delete_message()
+    with contextlib.suppress(Exception):
+        await query.delete_message()
 
-    elif data == "export_stats":
-        csv_data = DataManager.export_stats_csv()
-        await query.message.reply_document(
-            document=BytesIO(csv_data),
-            filename="stats.csv",
-            caption="فایل CSV آمار",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data="admin_panel")]]),
-        )
-        with contextlib.suppress(Exception):
-            await query.delete_message()
+@callback_router.exact("export_stats", admin_only=True)
+async def admin_export_stats(query, context, arg: str):
+    csv_data = DataManager.export_stats_csv()
+    await query.message.reply_document(
+        document=BytesIO(csv_data),
+        filename="stats.csv",
+        caption="فایل CSV آمار",
+        reply_markup=BACK_TO_ADMIN_PANEL,
+    )
+    with contextlib.suppress(Exception):
+        await query.delete_message()
+
+@callback_router.exact("admin_bulk", admin_only=True)
+async def admin_bulk_menu(query, context, arg: str):
+    text, keyboard = menu_cache.get("admin_bulk", 0, render_bulk_menu)
+    await query.edit_message_text(text, reply_markup=keyboard)
+
+@callback_router.exact("bulk_approve", admin_only=True)
+@callback_router.exact("bulk_reject", admin_only=True)
+async def admin_bulk_prompt(query, context, arg: str):
+    action = "approve" if query.data == "bulk_approve" else "reject"
+    await query.edit_message_text(f"IDهای سفارش برای {action} گروهی را وارد کنید (با کاما جدا):")
+    context.user_data['bulk_action'] = action
+    return BULK_APPROVE_IDS
+
+@callback_router.exact("admin_close")
+async def admin_close_panel(query, context, arg: str):
+    await query.edit_message_text("پنل ادمین بسته شد.")
+
+@callback_router.exact("cancel")
+async def cancel_purchase(query, context, arg: str):
+    await query.edit_message_text("عملیات لغو شد.")
+    if 'pending_order_id' in context.user_data:
+        del context.user_data['pending_order_id']
+
+async def place_order(query, context, cfg: Dict):
+    """Open a pending order for a config already taken out of stock and send payment details."""
+    order_id = str(uuid.uuid4())
+    async with config_locks(cfg['id']):
+        # اگر در این فاصله بکاپی بازیابی شده باشد، کانفیگ از موجودی جدید هم برداشته می‌شود
+        DataManager.take_config(cfg['id'])
+        DataManager.add_order(order_id, {
+            'user_id': query.from_user.id,
+            'username': query.from_user.username or "",
+            'config_id': cfg['id'],
+            'status': 'pending',
+            'timestamp': datetime.now().isoformat(),
+            'config_snapshot': cfg,
+        })
+        await DataManager.save_order(order_id)
+        await DataManager.save_configs(removed=[cfg['id']])
+    reservations.track(order_id, orders[order_id])
+
+    price_md = md_escape(str(cfg['price']))
+    cn_md = md_escape(CARD_NUMBER) if CARD_NUMBER else md_escape(redact_card(CARD_NUMBER))
+    nm_safe = md_escape(CARD_NAME or "")
+    oid_md = md_escape(order_id)
+    text = (
+        f"لطفاً مبلغ `{price_md}` تومان به شماره کارت زیر واریز کنید:\n"
+        f"`{cn_md}`\nنام: {nm_safe}\nID سفارش: `{oid_md}`\n"
+        "لطفاً عکس رسید پرداخت خود را همینجا ارسال کنید.\n\n💡 برای کپی ID سفارش، روی آن لمس کنید و کپی کنید."
+    )
+    await query.edit_message_text(text=text, parse_mode='MarkdownV2')
+    context.user_data['pending_order_id'] = order_id
 
-    elif data == "admin_bulk":
-        if user_id not in ADMINS:
-            await query.answer("❌ دسترسی ندارید.")
-            return
-        bulk_keyboard = [
-            [InlineKeyboardButton("✅ تأیید گروهی", callback_data="bulk_approve")],
-            [InlineKeyboardButton("❌ رد گروهی", callback_data="bulk_reject")],
-            [InlineKeyboardButton("🔙 بازگشت", callback_data="admin_panel")],
-        ]
-        await query.edit_message_text(
-            "برای Bulk Actions، IDهای سفارش را با کاما جدا کنید (مثل id1,id2):",
-            reply_markup=InlineKeyboardMarkup(bulk_keyboard),
-        )
+class ReservationExpiry:
+    """Heap of unpaid-order deadlines; one job_queue job fires at the earliest deadline."""
 
-    elif data in ["bulk_approve", "bulk_reject"]:
-        if user_id not in ADMINS:
-            await query.answer("❌ دسترسی ندارید.")
-            return
-        action = "approve" if data == "bulk_approve" else "reject"
-        await query.edit_message_text(f"IDهای سفارش برای {action} گروهی را وارد کنید (با کاما جدا):")
-        context.user_data['bulk_action'] = action
-        return BULK_APPROVE_IDS
+    def __init__(self):
+        self._heap: List[tuple] = []
+        self._job_queue = None
+        self._job = None
+        self._job_due: Optional[float] = None
 
-    elif data == "admin_close":
-        await query.edit_message_text("پنل ادمین بسته شد.")
-        return
+    def attach(self, job_queue):
+        self._job_queue = job_queue
+        self._reschedule()
 
-    elif data.startswith("buy_config_"):
+    @staticmethod
+    def _deadline(order: Dict) -> float:
         try:
-            config_id = int(data.split("_")[2])
-        except ValueError:
-            await query.edit_message_text("خطا در انتخاب کانفیگ.")
-            return
-        async with configs_lock, orders_lock:
-            cfg = configs.pop(config_id, None)
-            if not cfg:
-                await query.edit_message_text("کانفیگ مورد نظر موجود نیست (ممکن است قبلاً خریداری شده باشد).")
-                return
-            order_id = str(uuid.uuid4())
-            orders[order_id] = {
-                'user_id': user_id,
-                'username': query.from_user.username or "",
-                'config_id': config_id,
-                'status': 'pending',
-                'timestamp': datetime.now().isoformat(),
-                'config_snapshot': cfg,
-            }
-            await DataManager.save_orders()
-            await DataManager.save_configs()
-
-        price_md = md_escape(str(cfg['price']))
-        cn_md = md_escape(CARD_NUMBER) if CARD_NUMBER else md_escape(redact_card(CARD_NUMBER))
-        nm_safe = md_escape(CARD_NAME or "")
-        oid_md = md_escape(order_id)
-        text = (
-            f"لطفاً مبلغ `{price_md}` تومان به شماره کارت زیر واریز کنید:\n"
-            f"`{cn_md}`\nنام: {nm_safe}\nID سفارش: `{oid_md}`\n"
-            "لطفاً عکس رسید پرداخت خود را همینجا ارسال کنید.\n\n💡 برای کپی ID سفارش، روی آن لمس کنید و کپی کنید."
-        )
-        await query.edit_message_text(text=text, parse_mode='MarkdownV2')
-        context.user_data['pending_order_id'] = order_id
+            created = datetime.fromisoformat(order['timestamp']).timestamp()
+        except (KeyError, TypeError, ValueError):
+            created = time.time()
+        return created + RESERVATION_TTL
 
-    elif data.startswith("approve_") or data.startswith("reject_"):
-        if user_id not in ADMINS:
-            await query.answer("❌ دسترسی ندارید.")
+    def track(self, order_id: str, order: Dict):
+        if RESERVATION_TTL <= 0 or order.get('receipt_photo'):
             return
-        action = "approve" if data.startswith("approve_") else "reject"
-        order_id = data.split("_", 1)[1]
-        await process_order_action(query, context, order_id, action)
+        deadline = self._deadline(order)
+        heapq.heappush(self._heap, (deadline, order_id))
+        if self._job_due is None or deadline < self._job_due:
+            self._reschedule()
+
+    def track_pending(self, all_orders: Dict[str, Dict]):
+        for order_id, order in all_orders.items():
+            if order.get('status') == 'pending':
+                self.track(order_id, order)
+
+    def _reschedule(self):
+        if self._job_queue is None:
+            return
+        if self._job is not None:
+            self._job.schedule_removal()
+            self._job = None
+            self._job_due = None
+        if self._heap:
+            due = self._heap[0][0]
+            self._job = self._job_queue.run_once(self._fire, when=max(0.0, due - time.time()), name="reservation_expiry")
+            self._job_due = due
+
+    async def _fire(self, context: ContextTypes.DEFAULT_TYPE):
+        self._job = None
+        self._job_due = None
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            _, order_id = heapq.heappop(self._heap)
+            try:
+                await expire_reservation(context, order_id)
+            except Exception as e:
+                logger.error(f"Error expiring order {order_id}: {e}", exc_info=True)
+        self._reschedule()
 
-    elif data == "cancel":
-        await query.edit_message_text("عملیات لغو شد.")
-        if 'pending_order_id' in context.user_data:
-            del context.user_data['pending_order_id']
+reservations = ReservationExpiry()
 
-async def process_order_action(query, context, order_id: str, action: str):
-    async with orders_lock:
-        if order_id not in orders:
-            await query.answer("سفارش یافت نشد!")
-            return
-        order = orders[order_id]
-        if order['status'] != 'pending':
-            await query.answer("این سفارش قبلاً پردازش شده است!")
+async def expire_reservation(context: ContextTypes.DEFAULT_TYPE, order_id: str):
+    """Cancel an unpaid pending order and put its config back in stock."""
+    async with order_locks(order_id):
+        order = orders.get(order_id)
+        if order is None or order['status'] != 'pending' or order.get('receipt_photo'):
             return
-        config_snapshot = order.get('config_snapshot')
-        if action == "approve" and not config_snapshot:
-            await query.answer("کانفیگ یافت نشد!")
+        DataManager.set_status(order_id, 'expired')
+        notification_outbox.stage(order_id, order)
+        await DataManager.save_order(order_id)
+    cfg = order.get('config_snapshot')
+    if cfg:
+        async with config_locks(cfg['id']):
+            DataManager.put_config(cfg)
+            await DataManager.save_configs(changed=[cfg])
+    logger.info(f"Order {order_id} expired without receipt")
+    notification_outbox.dispatch(order_id)
+
+# وظایف ثبت خطای ویرایش کپشن؛ ارجاع نگه داشته می‌شود تا GC آن‌ها را جمع نکند
+caption_tasks: Set[asyncio.Task] = set()
+
+async def record_caption_failures(order_id: str, targets: List[tuple], futures: List[asyncio.Future]):
+    """Wait for the caption edits of an order and store the failed (chat, message) pairs in one write."""
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    failures = {
+        str(chat_id): {"message_id": msg_id, "error": str(result)}
+        for (chat_id, msg_id), result in zip(targets, results)
+        if isinstance(result, Exception)
+    }
+    if not failures:
+        return
+    async with order_locks(order_id):
+        order = await DataManager.get_order(order_id)
+        if order is None:
+            logger.error(f"Order {order_id} disappeared before its caption failures were recorded")
             return
-        try:
-            user_id = order['user_id']
-            if action == "approve":
-                link_md = md_escape(config_snapshot.get('link', '')) if config_snapshot else md_escape("link_not_found")
-                oid_md = md_escape(order_id)
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=(
-                        f"✅ پرداخت شما تأیید شد!\n🎉 کانفیگ شما:\n`{link_md}`\n\n"
-                        f"ID سفارش: `{oid_md}`\n💡 برای کپی ID، روی آن لمس کنید."
-                    ),
-                    parse_mode='MarkdownV2',
-                )
-                orders[order_id]['status'] = 'approved'
-                status_text = "✅ پرداخت تأیید شد"
-            else:
-                oid_md = md_escape(order_id)
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=(
-                        "❌ پرداخت شما رد شد!\n⚠️ لطفاً به پشتیبانی مراجعه کنید: @manava_vpn\n\n"
-                        f"ID سفارش: `{oid_md}`\n💡 برای کپی ID، روی آن لمس کنید."
-                    ),
-                    parse_mode='MarkdownV2',
-                )
-                orders[order_id]['status'] = 'rejected'
-                cfg_snapshot = order.get('config_snapshot')
-                if cfg_snapshot:
-                    async with configs_lock:
-                        configs[cfg_snapshot['id']] = cfg_snapshot
-                        await DataManager.save_configs()
-                status_text = "❌ پرداخت رد شد"
+        order['caption_failures'] = {**order.get('caption_failures', {}), **failures}
+        await DataManager.put_orders([(order_id, order)])
+
+def notify_order_outcome(context: ContextTypes.DEFAULT_TYPE, order_id: str, order: Dict) -> tuple:
+    """Deliver the staged customer message and queue admin caption edits for a processed order.
+
+    Returns the delivery task of the customer message and the admin-facing status text.
+    """
+    status_text = "✅ پرداخت تأیید شد" if order['status'] == 'approved' else "❌ پرداخت رد شد"
+    delivery = notification_outbox.dispatch(order_id)
+
+    display_text = f"{status_text}:\n👤 کاربر: {order['user_id']}\n📋 ID سفارش: `{md_escape(order_id)}`\n"
+    targets = list(order.get('admin_messages', {}).items())
+    gid = order.get('group_chat_id')
+    mid = order.get('group_message_id')
+    if gid and mid:
+        targets.append((gid, mid))
+    futures = [
+        outbound.submit(
+            context.bot.edit_message_caption,
+            chat_id=int(chat_id),
+            priority=OutboundDispatcher.PRIORITY_CAPTION,
+            description=f"caption edit for order {order_id}",
+            message_id=msg_id,
+            caption=display_text,
+            reply_markup=None,
+            parse_mode='MarkdownV2',
+        )
+        for chat_id, msg_id in targets
+    ]
+    if futures:
+        task = asyncio.get_running_loop().create_task(record_caption_failures(order_id, targets, futures))
+        caption_tasks.add(task)
+        task.add_done_callback(caption_tasks.discard)
+    return delivery, display_text
 
-            await DataManager.save_orders()
+async def process_order_action(query, context, order_id: str, action: str):
+    error = None
+    async with order_locks(order_id):
+        order = orders.get(order_id)
+        if order is None:
+            error = "این سفارش قبلاً پردازش شده است!" if await DataManager.get_order(order_id) else "سفارش یافت نشد!"
+        elif order['status'] != 'pending':
+            error = "این سفارش قبلاً پردازش شده است!"
+        elif action == "approve" and not order.get('config_snapshot'):
+            error = "کانفیگ یافت نشد!"
+        else:
+            DataManager.set_status(order_id, 'approved' if action == "approve" else 'rejected')
+            notification_outbox.stage(order_id, order)
+            try:
+                await DataManager.save_order(order_id)
+            except Exception as e:
+                notification_outbox.unstage(order_id, order)
+                DataManager.set_status(order_id, 'pending')
+                logger.error(f"Error in {action}: {e}", exc_info=True)
+                error = "خطا در پردازش!"
+    if error:
+        await query.answer(error)
+        return
+    with contextlib.suppress(Exception):
+        await query.answer()
 
-            oid_md2 = md_escape(order_id)
-            display_text = f"{status_text}:\n👤 کاربر: {order['user_id']}\n📋 ID سفارش: `{oid_md2}`\n"
-            admin_msgs = order.get('admin_messages', {})
-            for admin_id, msg_id in admin_msgs.items():
-                with contextlib.suppress(Exception):
-                    await context.bot.edit_message_caption(
-                        chat_id=admin_id,
-                        message_id=msg_id,
-                        caption=display_text,
-                        reply_markup=None,
-                        parse_mode='MarkdownV2'
-                    )
-            gid = order.get('group_chat_id')
-            mid = order.get('group_message_id')
-            if gid and mid:
-                with contextlib.suppress(Exception):
-                    await context.bot.edit_message_caption(
-                        chat_id=gid,
-                        message_id=mid,
-                        caption=display_text,
-                        reply_markup=None,
-                        parse_mode='MarkdownV2'
-                    )
+    config_snapshot = order.get('config_snapshot')
+    if action == "reject" and config_snapshot:
+        async with config_locks(config_snapshot['id']):
+            DataManager.put_config(config_snapshot)
+            await DataManager.save_configs(changed=[config_snapshot])
 
-            with contextlib.suppress(Exception):
-                await query.edit_message_text(
-                    text=display_text,
-                    reply_markup=None,
-                    parse_mode='MarkdownV2'
-                )
+    _, display_text = notify_order_outcome(context, order_id, order)
 
-        except Exception as e:
-            logger.error(f"Error in {action}: {e}", exc_info=True)
-            await query.answer("خطا در پردازش!")
-
-async def show_orders_page(target, context, page: int):
-    async with orders_lock:
-        pending = [(oid, o) for oid, o in orders.items() if o.get('status') == 'pending']
-    pending_orders = sorted(pending, key=lambda x: x[1].get('timestamp', ''), reverse=True)
-    total = len(pending_orders)
-    total_pages = max(1, (total + ORDERS_PER_PAGE - 1) // ORDERS_PER_PAGE)
-    page = max(1, min(page, total_pages))
+    with contextlib.suppress(Exception):
+        await query.edit_message_text(
+            text=display_text,
+            reply_markup=None,
+            parse_mode='MarkdownV2'
+        )
 
-    start_idx = (page - 1) * ORDERS_PER_PAGE
-    end_idx = start_idx + ORDERS_PER_PAGE
-    page_orders = pending_orders[start_idx:end_idx]
+async def show_orders_page(target, context, cursor: Optional[str] = None):
+    order_ids, newer, older, page = pending_index.page(cursor, ORDERS_PER_PAGE)
+    if not order_ids and len(pending_index):
+        order_ids, newer, older, page = pending_index.page(None, ORDERS_PER_PAGE)
+    total = len(pending_index)
+    total_pages = max(1, (total + ORDERS_PER_PAGE - 1) // ORDERS_PER_PAGE)
+    page_orders = [(oid, orders[oid]) for oid in order_ids]
 
     if total == 0:
         text = "هیچ سفارش در انتظاری وجود ندارد."
@@ -767,10 +3141,10 @@ async def show_orders_page(target, context, page: int):
         ])
 
     pag_buttons = []
-    if page > 1:
-        pag_buttons.append(InlineKeyboardButton("◀️ قبلی", callback_data=f"orders_page_{page-1}"))
-    if page < total_pages:
-        pag_buttons.append(InlineKeyboardButton("بعدی ▶️", callback_data=f"orders_page_{page+1}"))
+    if newer:
+        pag_buttons.append(InlineKeyboardButton("◀️ قبلی", callback_data=f"orders_page_{newer}"))
+    if older:
+        pag_buttons.append(InlineKeyboardButton("بعدی ▶️", callback_data=f"orders_page_{older}"))
     if pag_buttons:
         keyboard_rows.append(pag_buttons)
     keyboard_rows.append([InlineKeyboardButton("🔙 بازگشت", callback_data="admin_panel")])
@@ -789,7 +3163,7 @@ async def handle_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id in ADMINS:
         return
-    if is_rate_limited(user_id):
+    if is_rate_limited(user_id, "receipt"):
         await update.message.reply_text("⏳ لطفاً کمی صبر کنید.")
         return
     if 'pending_order_id' not in context.user_data:
@@ -797,10 +3171,10 @@ async def handle_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     order_id = context.user_data.pop('pending_order_id')
-    async with orders_lock:
-        if order_id not in orders or orders[order_id]['status'] != 'pending':
-            await update.message.reply_text("سفارش نامعتبر است.")
-            return
+    order = orders.get(order_id)
+    if order is None or order['status'] != 'pending':
+        await update.message.reply_text("سفارش نامعتبر است.")
+        return
 
     if not update.message.photo:
         await update.message.reply_text("لطفاً عکس رسید ارسال کنید.")
@@ -808,19 +3182,26 @@ async def handle_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     photo_id = update.message.photo[-1].file_id
-    async with orders_lock:
-        orders[order_id]['receipt_photo'] = photo_id
-        await DataManager.save_orders()
+    async with order_locks(order_id):
+        # بازیابی بکاپ ممکن است قبل از گرفتن قفل دیکشنری سفارش را عوض کرده باشد
+        order = orders.get(order_id)
+        if order is None or order['status'] != 'pending':
+            await update.message.reply_text("سفارش نامعتبر است.")
+            return
+        order['receipt_photo'] = photo_id
+        await DataManager.save_order(order_id)
 
     await update.message.reply_text("✅ رسید دریافت شد. منتظر تایید ادمین باشید.")
 
-    order = orders[order_id]
-    cfg = order.get('config_snapshot')
+    await deliver_receipt(context, order_id, photo_id, update.effective_user.mention_html(), [*ADMINS, ADMIN_GROUP_ID])
+
+async def deliver_receipt(context: ContextTypes.DEFAULT_TYPE, order_id: str, photo_id: str, user_mention: str, recipients: List[int]):
+    """Send the receipt to all recipients at once and record the outcome with a single write."""
+    order = orders.get(order_id)
+    cfg = order.get('config_snapshot') if order else None
     if not cfg:
         logger.error(f"Config snapshot not found for order: {order_id}")
         return
-
-    user_mention = update.effective_user.mention_html()
     caption_html = (
         f"📨 سفارش جدید با رسید:\n"
         f"👤 کاربر: {user_mention}\n"
@@ -838,45 +3219,69 @@ async def handle_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]
     ])
 
-    admin_messages: Dict[int, int] = {}
-    for admin in ADMINS:
-        try:
-            admin_message = await context.bot.send_photo(
-                chat_id=admin,
-                photo=photo_id,
-                caption=caption_html,
-                reply_markup=admin_keyboard,
-                parse_mode='HTML',
-            )
-            admin_messages[admin] = admin_message.message_id
-        except Exception as e:
-            logger.error(f"Error sending to admin {admin}: {e}")
-
-    async with orders_lock:
-        orders[order_id]['admin_messages'] = admin_messages
-        await DataManager.save_orders()
-
-    try:
-        group_message = await context.bot.send_photo(
-            chat_id=ADMIN_GROUP_ID,
+    results = await asyncio.gather(*(
+        outbound.send(
+            context.bot.send_photo,
+            chat_id=chat_id,
+            priority=OutboundDispatcher.PRIORITY_ADMIN,
             photo=photo_id,
-            caption=caption_html.replace("نوتیفیکیشن جدید", "نوتیفیکیشن گروهی"),
+            caption=caption_html if chat_id != ADMIN_GROUP_ID else caption_html.replace("نوتیفیکیشن جدید", "نوتیفیکیشن گروهی"),
             reply_markup=admin_keyboard,
             parse_mode='HTML',
         )
-        async with orders_lock:
-            orders[order_id]['group_chat_id'] = group_message.chat.id
-            orders[order_id]['group_message_id'] = group_message.message_id
-            await DataManager.save_orders()
-    except Exception as e:
-        logger.error(f"Error sending to group: {e}")
+        for chat_id in recipients
+    ), return_exceptions=True)
+
+    async with order_locks(order_id):
+        # ممکن است سفارش در حین ارسال تأیید شده و از حافظه خارج شده باشد
+        order = await DataManager.get_order(order_id)
+        if order is None:
+            logger.error(f"Order {order_id} disappeared while its receipt was being delivered")
+            return
+        admin_messages = {int(chat_id): msg_id for chat_id, msg_id in order.get('admin_messages', {}).items()}
+        failures = dict(order.get('delivery_failures', {}))
+        for chat_id, result in zip(recipients, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error sending receipt of order {order_id} to {chat_id}: {result}")
+                failures[str(chat_id)] = str(result)
+                continue
+            failures.pop(str(chat_id), None)
+            if chat_id == ADMIN_GROUP_ID:
+                order['group_chat_id'] = result.chat.id
+                order['group_message_id'] = result.message_id
+            else:
+                admin_messages[chat_id] = result.message_id
+        order['admin_messages'] = admin_messages
+        if failures:
+            order['delivery_failures'] = failures
+        else:
+            order.pop('delivery_failures', None)
+        await DataManager.put_orders([(order_id, order)])
+
+async def retry_receipts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in ADMINS:
+        await update.message.reply_text("❌ دسترسی ندارید.")
+        return
+    retried = 0
+    for order_id in pending_index.order_ids():
+        order = orders.get(order_id)
+        if order is None:
+            continue
+        failed = order.get('delivery_failures')
+        if not failed or not order.get('receipt_photo'):
+            continue
+        user_mention = mention_html(order['user_id'], order.get('username') or str(order['user_id']))
+        await deliver_receipt(context, order_id, order['receipt_photo'], user_mention, [int(chat_id) for chat_id in failed])
+        retried += 1
+    await update.message.reply_text(f"🔁 ارسال مجدد رسید برای {retried} سفارش انجام شد.")
 
 async def list_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id not in ADMINS:
         await update.message.reply_text("❌ دسترسی ندارید.")
         return
-    await show_orders_page(update, context, page=1)
+    await show_orders_page(update, context)
 
 async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -890,8 +3295,21 @@ async def export_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_id not in ADMINS:
         await update.message.reply_text("❌ دسترسی ندارید.")
         return
-    csv_data = DataManager.export_orders_csv()
-    await update.message.reply_document(document=BytesIO(csv_data), filename="orders.csv", caption="فایل CSV سفارش‌ها")
+    try:
+        filters, compress = parse_export_filters(context.args or [])
+    except ValueError:
+        await update.message.reply_text(
+            "فرمت فیلتر نامعتبر است. نمونه:\n"
+            "/export_orders status=approved from=2026-01-01 to=2026-01-31 user=123 group=\"10GB - 30d\" gz"
+        )
+        return
+    export_file = await DataManager.export_orders_csv(filters, compress)
+    with export_file:
+        await update.message.reply_document(
+            document=export_file,
+            filename="orders.csv.gz" if compress else "orders.csv",
+            caption="فایل CSV سفارش‌ها",
+        )
 
 async def export_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -935,18 +3353,12 @@ async def add_config_price(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return ADD_CONFIG_PRICE
 
 async def add_config_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    global config_id_counter
     try:
-        # پاکسازی لینک از mentionهای اضافی
-        link = re.sub(r'--@ghalagyann2', '', update.message.text)
-        link = re.sub(r'----@Shh_Proxy', '', link).strip()
-        async with configs_lock:
-            config = context.user_data.pop('new_config')
-            config['id'] = config_id_counter
-            config['link'] = link
-            configs[config['id']] = config
-            config_id_counter += 1
-            await DataManager.save_configs()
+        link = clean_config_link(update.message.text)
+        config = context.user_data.pop('new_config')
+        config['link'] = link
+        # شناسه زیر state gate گرفته می‌شود تا با شمارنده بازیابی‌شده تداخل نکند
+        await DataManager.add_configs([config])
         await update.message.reply_text("✅ کانفیگ اضافه شد.")
     except Exception as e:
         logger.error(f"Error in add_config_link: {e}", exc_info=True)
@@ -964,10 +3376,9 @@ async def remove_config(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 async def remove_config_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         config_id = int(update.message.text)
-        async with configs_lock:
-            if config_id in configs:
-                del configs[config_id]
-                await DataManager.save_configs()
+        async with config_locks(config_id):
+            if DataManager.take_config(config_id) is not None:
+                await DataManager.save_configs(removed=[config_id])
                 await update.message.reply_text("✅ کانفیگ حذف شد.")
             else:
                 await update.message.reply_text("کانفیگ یافت نشد.")
@@ -989,49 +3400,85 @@ async def bulk_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     if not order_ids:
         await update.message.reply_text("هیچ ID سفارشی وارد نشده است.")
         return ConversationHandler.END
-    success = 0
-    to_notify = []
-    for order_id in order_ids:
-        async with orders_lock:
-            if order_id in orders and orders[order_id]['status'] == 'pending':
-                order = orders[order_id]
-                orders[order_id]['status'] = action
-                if action == 'reject':
-                    cfg_snapshot = order.get('config_snapshot')
-                    if cfg_snapshot:
-                        async with configs_lock:
-                            configs[cfg_snapshot['id']] = cfg_snapshot
-                success += 1
-                to_notify.append((order_id, order['user_id'], order.get('config_snapshot', {})))
-    await DataManager.save_orders()
+    order_ids = list(dict.fromkeys(order_ids))
+    new_status = 'approved' if action == 'approve' else 'rejected'
+    processed: List[tuple] = []
+    async with order_locks.hold(order_ids):
+        for order_id in order_ids:
+            order = orders.get(order_id)
+            if order is None or order['status'] != 'pending':
+                continue
+            if action == 'approve' and not order.get('config_snapshot'):
+                continue
+            DataManager.set_status(order_id, new_status)
+            notification_outbox.stage(order_id, order)
+            processed.append((order_id, order))
+        try:
+            await DataManager.save_order(*(oid for oid, _ in processed))
+        except Exception as e:
+            for order_id, order in processed:
+                notification_outbox.unstage(order_id, order)
+                DataManager.set_status(order_id, 'pending')
+            logger.error(f"Error in bulk {action}: {e}", exc_info=True)
+            await update.message.reply_text("❌ خطا در ذخیره سفارش‌ها. هیچ تغییری اعمال نشد.")
+            return ConversationHandler.END
     if action == 'reject':
-        await DataManager.save_configs()
-    # Send notifications outside lock
-    for oid, uid, cfg in to_notify:
-        if action == 'approve':
-            link_md = md_escape(cfg.get('link', ''))
-            oid_md = md_escape(oid)
-            await context.bot.send_message(
-                chat_id=uid,
-                text=(
-                    f"✅ پرداخت شما تأیید شد!\n🎉 کانفیگ شما:\n`{link_md}`\n\n"
-                    f"ID سفارش: `{oid_md}`\n💡 برای کپی ID، روی آن لمس کنید."
-                ),
-                parse_mode='MarkdownV2',
-            )
-        else:
-            oid_md = md_escape(oid)
-            await context.bot.send_message(
-                chat_id=uid,
-                text=(
-                    "❌ پرداخت شما رد شد!\n⚠️ لطفاً به پشتیبانی مراجعه کنید: @manava_vpn\n\n"
-                    f"ID سفارش: `{oid_md}`\n💡 برای کپی ID، روی آن لمس کنید."
-                ),
-                parse_mode='MarkdownV2',
-            )
-    await update.message.reply_text(f"✅ {success} سفارش با موفقیت {action} شدند.")
+        returned = [order['config_snapshot'] for _, order in processed if order.get('config_snapshot')]
+        async with config_locks.hold(cfg['id'] for cfg in returned):
+            for cfg in returned:
+                DataManager.put_config(cfg)
+            await DataManager.save_configs(changed=returned)
+
+    skipped = len(order_ids) - len(processed)
+    progress = await update.message.reply_text(
+        f"✅ {len(processed)} سفارش {new_status} شدند ({skipped} نامعتبر یا قبلاً پردازش‌شده).\n"
+        f"⏳ ارسال اعلان‌ها: 0/{len(processed)}"
+    )
+    if processed:
+        context.application.create_task(notify_bulk_outcome(context, processed, progress))
     return ConversationHandler.END
 
+async def notify_bulk_outcome(context: ContextTypes.DEFAULT_TYPE, processed: List[tuple], progress):
+    """Deliver bulk notifications concurrently and keep the admin's progress message current."""
+    total = len(processed)
+    futures = {}
+    for order_id, order in processed:
+        delivery, _ = notify_order_outcome(context, order_id, order)
+        futures[delivery] = order_id
+    failed: List[str] = []
+    done = 0
+    step = max(1, total // 10)
+    header = progress.text.split("\n")[0]
+    for delivery in asyncio.as_completed(list(futures)):
+        try:
+            await delivery
+        except Exception:
+            pass
+        done += 1
+        if done % step == 0 and done < total:
+            with contextlib.suppress(Exception):
+                await outbound.send(
+                    context.bot.edit_message_text,
+                    chat_id=progress.chat_id,
+                    priority=OutboundDispatcher.PRIORITY_ADMIN,
+                    message_id=progress.message_id,
+                    text=f"{header}\n⏳ ارسال اعلان‌ها: {done}/{total}",
+                )
+    for delivery, order_id in futures.items():
+        if delivery.exception() is not None:
+            failed.append(order_id)
+    summary = f"{header}\n📨 اعلان‌ها: {total - len(failed)} موفق، {len(failed)} ناموفق"
+    if failed:
+        summary += "\nناموفق:\n" + "\n".join(failed[:50])
+    with contextlib.suppress(Exception):
+        await outbound.send(
+            context.bot.edit_message_text,
+            chat_id=progress.chat_id,
+            priority=OutboundDispatcher.PRIORITY_ADMIN,
+            message_id=progress.message_id,
+            text=summary,
+        )
+
 async def error_handler(update: Optional[Update], context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Error: {context.error}", exc_info=True)
     try:
@@ -1042,6 +3489,141 @@ async def error_handler(update: Optional[Update], context: ContextTypes.DEFAULT_
     except Exception:
         pass
 
+# Webhook deduplication
+class UpdateDeduplicator:
+    """Bounded window of claimed update IDs plus a persisted high-water mark.
+
+    Telegram update IDs increase monotonically, so anything at or below the
+    floor (IDs evicted from the window, or the mark saved before a restart)
+    is a duplicate.
+    """
+
+    def __init__(self, window: int, state_file: str):
+        self.window = window
+        self.state_file = state_file
+        self._recent: deque = deque()
+        self._claimed: Set[int] = set()
+        self.floor = 0
+        self.high_water = 0
+        self._saved = 0
+        self._save_task: Optional[asyncio.Task] = None
+
+    def load(self):
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                self.floor = self.high_water = self._saved = int(json.load(f).get("high_water", 0))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Error loading webhook state: {e}")
+
+    def claim(self, update_id: int) -> bool:
+        """Mark an update as in flight; False if it was already seen."""
+        if update_id <= self.floor and self.floor - update_id > self.window:
+            # بعد از یک هفته بدون آپدیت، تلگرام شمارنده را تصادفی از نو شروع می‌کند
+            logger.warning(f"Update ID sequence restarted at {update_id}, resetting deduplication window")
+            self._recent.clear()
+            self._claimed.clear()
+            self.floor = self.high_water = self._saved = update_id - 1
+        if update_id <= self.floor or update_id in self._claimed:
+            return False
+        self._claimed.add(update_id)
+        self._recent.append(update_id)
+        if len(self._recent) > self.window:
+            evicted = self._recent.popleft()
+            self._claimed.discard(evicted)
+            self.floor = max(self.floor, evicted)
+        if update_id > self.high_water:
+            self.high_water = update_id
+            self._schedule_save()
+        return True
+
+    def release(self, update_id: int):
+        """Forget a claim whose processing failed so Telegram's retry is accepted."""
+        self._claimed.discard(update_id)
+
+    def _schedule_save(self):
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self.save())
+
+    async def save(self):
+        # یک نوشتن در هر لحظه؛ اگر در حین نوشتن مقدار جلو رفت دوباره ذخیره می‌شود
+        while self._saved < self.high_water:
+            mark = self.high_water
+            try:
+                await atomic_write(self.state_file, json.dumps({"high_water": mark}))
+            except Exception as e:
+                logger.error(f"Error saving webhook state: {e}")
+                return
+            self._saved = mark
+
+update_dedup = UpdateDeduplicator(WEBHOOK_DEDUP_WINDOW, WEBHOOK_STATE_FILE)
+
+# Update worker pool
+class UpdateQueue:
+    """Bounded update queues, one per worker; a chat always maps to the same worker to keep its order."""
+
+    def __init__(self, workers: int, maxsize: int):
+        workers = max(1, workers)
+        self._queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=max(1, maxsize // workers)) for _ in range(workers)]
+        self._tasks: List[asyncio.Task] = []
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def start(self, application: Application):
+        for queue in self._queues:
+            self._tasks.append(asyncio.create_task(self._worker(queue, application)))
+
+    async def stop(self, timeout: float = 10.0):
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @staticmethod
+    def _shard_key(update: Update) -> int:
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return update.update_id
+
+    def submit(self, update: Update) -> bool:
+        """Queue an update without waiting; False if its worker's queue is full."""
+        queue = self._queues[self._shard_key(update) % len(self._queues)]
+        try:
+            queue.put_nowait(update)
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+
+    def metrics(self) -> Dict:
+        return {
+            "queue_depth": [q.qsize() for q in self._queues],
+            "queue_capacity": self._queues[0].maxsize,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
+
+    async def _worker(self, queue: asyncio.Queue, application: Application):
+        while True:
+            update = await queue.get()
+            try:
+                await application.process_update(update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Error processing update {update.update_id}: {e}", exc_info=True)
+            finally:
+                queue.task_done()
+
+update_queue = UpdateQueue(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+
 # Webhook handler for aiohttp
 async def webhook_handler(request: web.Request):
     app = request.app['telegram_app']
@@ -1053,18 +3635,27 @@ async def webhook_handler(request: web.Request):
             return web.Response(status=403)
         data = await request.json()
         update_id = data.get('update_id')
-        if update_id in processed_updates:
-            logger.debug(f"Update {update_id} already processed, skipping")
+        if not isinstance(update_id, int):
+            logger.warning("Webhook payload without a valid update_id")
+            return web.Response(status=200)
+        if not update_dedup.claim(update_id):
+            logger.debug(f"Update {update_id} already seen, skipping")
             return web.Response(status=200)
         logger.debug(f"Webhook data received: {data}")
-        update = Update.de_json(data, app.bot)
-        if update:
-            logger.info(f"Processing update: {update.update_id}")
-            await app.process_update(update)
-            processed_updates.add(update_id)
-            logger.info(f"Update {update.update_id} processed successfully")
-        else:
+        try:
+            update = Update.de_json(data, app.bot)
+        except Exception:
+            update_dedup.release(update_id)
+            raise
+        if not update:
             logger.warning("No valid update object created from webhook data")
+            return web.Response(status=200)
+        if not update_queue.submit(update):
+            # صف پر است؛ تلگرام بعداً دوباره ارسال می‌کند
+            update_dedup.release(update_id)
+            logger.warning(f"Update queue full, deferring update {update_id}")
+            return web.Response(status=503)
+        logger.info(f"Queued update: {update_id}")
         return web.Response(status=200)
     except Exception as e:
         logger.error(f"Webhook error: {e}", exc_info=True)
@@ -1074,6 +3665,10 @@ async def webhook_handler(request: web.Request):
 async def handle_ping(request: web.Request):
     return web.Response(text="OK")
 
+async def handle_metrics(request: web.Request):
+    return web.json_response({**update_queue.metrics(), **outbound.metrics(), **rate_limiter.metrics(),
+                              **callback_router.metrics(), **menu_cache.metrics()})
+
 async def test_telegram_api():
     async with httpx.AsyncClient(timeout=30.0) as client:
         try:
@@ -1086,7 +3681,7 @@ async def test_telegram_api():
             return False
 
 async def main():
-    global ADMINS, ADMIN_GROUP_ID
+    global ADMINS, ADMIN_IDS, ADMIN_GROUP_ID
     try:
         await DataManager.check_env()
         ADMIN_GROUP_ID = int(ADMIN_GROUP_ID_STR)
@@ -1094,6 +3689,7 @@ async def main():
         if not ADMINS:
             logger.error("No valid admin IDs provided in ADMINS env variable")
             raise ValueError("ADMINS is empty or invalid")
+        ADMIN_IDS = frozenset(ADMINS)
     except (ValueError, AttributeError) as e:
         logger.error(f"Env error: {e}")
         return
@@ -1107,6 +3703,7 @@ async def main():
     await DataManager.load_orders()
     await DataManager.load_blacklist()
     await DataManager.load_configs()
+    update_dedup.load()
 
     # Configure Application with pool_timeout
     application = Application.builder().token(TOKEN).persistence(PicklePersistence(filepath=PERSISTENCE_FILE)).pool_timeout(30.0).build()
@@ -1151,10 +3748,16 @@ async def main():
     application.add_handler(MessageHandler(filters.PHOTO & ~filters.COMMAND, handle_receipt))
     application.add_handler(CommandHandler("backup", backup_command))
     application.add_handler(CommandHandler("restore", restore_help_command))
+    application.add_handler(CommandHandler("retry_receipts", retry_receipts))
     if ADMINS:
-        application.add_handler(MessageHandler(filters.Document.ALL & filters.User(user_id=ADMINS), restore_file_handler))
+        application.add_handler(MessageHandler(filters.Document.ALL & filters.User(user_id=ADMINS), document_handler))
     application.add_error_handler(error_handler)
 
+    # انقضای رزرو سفارش‌های پرداخت‌نشده
+    reservations.track_pending(orders)
+    reservations.attach(application.job_queue)
+    notification_outbox.attach(application.bot, application.job_queue)
+
     # تنظیم JobQueue برای بکاپ
     if ADMINS and BACKUP_INTERVAL > 0:
         async def scheduled_backup(context: ContextTypes.DEFAULT_TYPE):
@@ -1169,6 +3772,7 @@ async def main():
     aiohttp_app['telegram_app'] = application
     aiohttp_app.router.add_post('/', webhook_handler)
     aiohttp_app.router.add_get('/ping', handle_ping)
+    aiohttp_app.router.add_get('/metrics', handle_metrics)
 
     async def setup_webhook():
         try:
@@ -1188,6 +3792,9 @@ async def main():
         try:
             await application.initialize()
             await application.start()
+            outbound.start()
+            user_registrar.start()
+            update_queue.start(application)
             await setup_webhook()
             logger.info("Application started with Webhook")
         except Exception as e:
@@ -1195,11 +3802,23 @@ async def main():
             raise
 
     async def stop_application():
+        await update_queue.stop()
+        await outbound.stop()
+        try:
+            await user_registrar.stop()
+        except Exception as e:
+            logger.error(f"Error flushing new users: {e}", exc_info=True)
+        try:
+            await DataManager.save_orders()
+            await update_dedup.save()
+        except Exception as e:
+            logger.error(f"Error compacting orders journal: {e}", exc_info=True)
         try:
             if application.updater and application.updater.running:
                 await application.updater.stop()
             await application.stop()
             await application.bot.delete_webhook(drop_pending_updates=True)
+            storage.close()
             logger.info("Application stopped")
         except Exception as e:
             logger.error(f"Error stopping application: {e}", exc_info=True)
@@ -1225,6 +3844,9 @@ async def main():
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if len(sys.argv) > 1 and sys.argv[1] == "migrate-sqlite":
+            asyncio.run(migrate_to_sqlite())
+        else:
+            asyncio.run(main())
     except Exception as e:
         logger.error(f"Main error: {e}", exc_info=True)
@@ -0,0 +1,202 @@
+"""Concurrent buy → receipt → approve/reject flows against both storage backends.
+
+The Telegram bot is replaced by a stub that answers every API call after a
+short random delay, so the flows interleave the way they do under load.
+"""
+import asyncio
+import itertools
+import random
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import main  # noqa: E402
+
+ADMIN_ID = 900
+ADMIN_GROUP = -100
+BUYERS = 300
+STOCK = 200
+
+
+class FakeBot:
+    """Answers any Bot API method with a message-like object."""
+
+    def __init__(self):
+        self.calls = []
+        self._message_ids = itertools.count(1)
+
+    def __getattr__(self, name):
+        async def call(*args, chat_id=None, **kwargs):
+            await asyncio.sleep(random.uniform(0, 0.002))
+            self.calls.append((name, chat_id))
+            return SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=next(self._message_ids), document=None)
+        return call
+
+
+class FakeQuery:
+    def __init__(self, user_id: int):
+        self.from_user = SimpleNamespace(id=user_id, username=f"user{user_id}")
+        self.texts = []
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, text=None, **kwargs):
+        await asyncio.sleep(random.uniform(0, 0.002))
+        self.texts.append(text)
+
+
+class FakeMessage:
+    def __init__(self, photo_id: str):
+        self.photo = [SimpleNamespace(file_id=photo_id)]
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def make_configs():
+    return [
+        {'id': i, 'volume': '10GB' if i % 2 else '20GB', 'duration': '30d', 'price': 100 if i % 2 else 200, 'link': f'vless://{i}'}
+        for i in range(1, STOCK + 1)
+    ]
+
+
+@pytest.fixture(params=["file", "sqlite"])
+def backend(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    if request.param == "sqlite":
+        storage = main.SQLiteStorage(str(tmp_path / "manava.db"))
+        reopen = lambda: main.SQLiteStorage(str(tmp_path / "manava.db"))
+    else:
+        storage = main.FileStorage(str(tmp_path))
+        reopen = lambda: main.FileStorage(str(tmp_path))
+    bot = FakeBot()
+    monkeypatch.setattr(main, "storage", storage)
+    monkeypatch.setattr(main, "ADMINS", [ADMIN_ID])
+    monkeypatch.setattr(main, "ADMIN_IDS", frozenset({ADMIN_ID}))
+    monkeypatch.setattr(main, "ADMIN_GROUP_ID", ADMIN_GROUP)
+    monkeypatch.setattr(main, "is_rate_limited", lambda *args, **kwargs: False)
+    monkeypatch.setattr(main, "outbound", main.OutboundDispatcher(16, 1e6, 1e6, 1e6, 1))
+    monkeypatch.setattr(main, "reservations", main.ReservationExpiry())
+    monkeypatch.setattr(main, "notification_outbox", main.NotificationOutbox())
+    monkeypatch.setattr(main, "backup_tracker", main.BackupTracker())
+    main.notification_outbox._bot = bot
+    main.DataManager.install_datasets(make_configs(), {}, set(), set())
+    yield SimpleNamespace(bot=bot, reopen=reopen)
+    storage.close()
+
+
+async def buyer_flow(bot, user_id: int, group_id: int) -> dict:
+    context = SimpleNamespace(bot=bot, user_data={}, application=None)
+    query = FakeQuery(user_id)
+    await main.buy_any_config(query, context, str(group_id))
+    order_id = context.user_data.get('pending_order_id')
+    if order_id is None:
+        return {}
+    update = SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id, mention_html=lambda: f"user{user_id}"),
+        message=FakeMessage(f"photo-{user_id}"),
+    )
+    receipt = asyncio.create_task(main.handle_receipt(update, context))
+    # ادمین‌ها در حالی که رسید هنوز در حال ارسال است روی سفارش کلیک می‌کنند
+    while not update.message.replies:
+        await asyncio.sleep(0)
+
+    action = "approve" if user_id % 3 else "reject"
+    admin_context = SimpleNamespace(bot=bot, user_data={}, application=None)
+    await asyncio.gather(
+        receipt,
+        main.process_order_action(FakeQuery(ADMIN_ID), admin_context, order_id, action),
+        main.process_order_action(FakeQuery(ADMIN_ID), admin_context, order_id, action),
+    )
+    return {order_id: action}
+
+
+def read_back(env, method: str):
+    storage = env.reopen()
+    try:
+        return asyncio.run(getattr(storage, method)())
+    finally:
+        storage.close()
+
+
+async def run_flows(env) -> dict:
+    main.outbound.start()
+    groups = [main.inventory.group_id(key) for key, _ in main.inventory.groups()]
+    results = await asyncio.gather(*(
+        buyer_flow(env.bot, user_id, groups[user_id % len(groups)]) for user_id in range(1, BUYERS + 1)
+    ))
+    await asyncio.gather(*list(main.notification_outbox._in_flight.values()), return_exceptions=True)
+    await main.outbound.stop()
+    expected = {}
+    for result in results:
+        expected.update(result)
+    return expected
+
+
+def test_no_order_lost_or_config_sold_twice(backend):
+    expected = asyncio.run(run_flows(backend))
+
+    # بیش از موجودی فروخته نشده و هر خرید یک سفارش ساخته است
+    assert len(expected) == STOCK
+
+    stored = read_back(backend, "all_orders")
+    assert set(stored) == set(expected)
+    for order_id, action in expected.items():
+        order = stored[order_id]
+        assert order['status'] == ('approved' if action == "approve" else 'rejected')
+        assert order.get('receipt_photo')
+        assert 'outbox' not in order
+        assert str(ADMIN_ID) in order.get('admin_messages', {})
+
+    approved = [o['config_id'] for o in stored.values() if o['status'] == 'approved']
+    rejected = [o['config_id'] for o in stored.values() if o['status'] == 'rejected']
+    assert len(approved) == len(set(approved))
+    assert len(rejected) == len(set(rejected))
+
+    # کانفیگ‌های ردشده به موجودی برگشته‌اند و هیچ کانفیگی هم فروخته و هم موجود نیست
+    in_stock = {cfg['id'] for cfg in read_back(backend, "load_configs")}
+    assert in_stock == set(main.configs) == set(rejected)
+    assert not in_stock & set(approved)
+    assert in_stock | set(approved) == set(range(1, STOCK + 1))
+
+    # هر مشتری دقیقاً یک اعلان نتیجه دریافت کرده است
+    customer_messages = [chat for name, chat in backend.bot.calls if name == "send_message" and chat != ADMIN_ID]
+    assert len(customer_messages) == STOCK
+
+
+def test_failed_caption_edits_are_recorded(backend):
+    async def refuse_edit(*args, chat_id=None, **kwargs):
+        if chat_id == ADMIN_GROUP:
+            raise main.BadRequest("Message to edit not found")
+        return True
+
+    backend.bot.edit_message_caption = refuse_edit
+
+    async def run():
+        main.outbound.start()
+        context = SimpleNamespace(bot=backend.bot, user_data={}, application=None)
+        group_id = main.inventory.group_id(main.inventory.groups()[0][0])
+        await main.buy_any_config(FakeQuery(1), context, group_id)
+        order_id = context.user_data['pending_order_id']
+        update = SimpleNamespace(
+            effective_user=SimpleNamespace(id=1, mention_html=lambda: "user1"),
+            message=FakeMessage("photo-1"),
+        )
+        # این بار رسید کامل تحویل شده و سپس ادمین تأیید می‌کند
+        await main.handle_receipt(update, context)
+        await main.process_order_action(FakeQuery(ADMIN_ID), context, order_id, "approve")
+        await asyncio.gather(*list(main.notification_outbox._in_flight.values()), return_exceptions=True)
+        await asyncio.gather(*list(main.caption_tasks))
+        await main.outbound.stop()
+        return order_id
+
+    order_id = asyncio.run(run())
+    order = read_back(backend, "all_orders")[order_id]
+    assert set(order['caption_failures']) == {str(ADMIN_GROUP)}
+    assert order['caption_failures'][str(ADMIN_GROUP)]['message_id'] == order['group_message_id']
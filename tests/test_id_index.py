@@ -0,0 +1,29 @@
+"""ID text files and their binary .idx sidecar."""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import main  # noqa: E402
+
+
+def test_appended_lines_are_picked_up(tmp_path):
+    path = str(tmp_path / "users.txt")
+    main.write_id_file(path, [111111, 222222])
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("333333\n")
+    assert list(main.load_id_file(path)) == [111111, 222222, 333333]
+    assert list(main.load_id_file(path)) == [111111, 222222, 333333]
+
+
+def test_hand_edited_file_rebuilds_index(tmp_path):
+    path = tmp_path / "blacklist.txt"
+    path.write_text("111111\n222222\n", encoding="utf-8")
+    assert list(main.load_id_file(str(path))) == [111111, 222222]
+
+    # ویرایش دستی که اندازه فایل را حفظ یا بزرگ‌تر می‌کند
+    path.write_text("333333\n444444\n555555\n", encoding="utf-8")
+    assert list(main.load_id_file(str(path))) == [333333, 444444, 555555]
+
+    path.write_text("666666\n777777\n888888\n", encoding="utf-8")
+    assert list(main.load_id_file(str(path))) == [666666, 777777, 888888]
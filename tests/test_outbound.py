@@ -0,0 +1,28 @@
+"""OutboundDispatcher behaviour that does not need a real bot."""
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import main  # noqa: E402
+
+
+async def slow_call(chat_id=None):
+    await asyncio.sleep(0.05)
+    return chat_id
+
+
+def test_cancelled_send_does_not_kill_worker():
+    async def run():
+        dispatcher = main.OutboundDispatcher(1, 1e6, 1e6, 1e6, 1)
+        dispatcher.start()
+        cancelled = asyncio.ensure_future(dispatcher.send(slow_call, chat_id=1))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        try:
+            return await asyncio.wait_for(dispatcher.send(slow_call, chat_id=2), 2)
+        finally:
+            await dispatcher.stop(1)
+
+    assert asyncio.run(run()) == 2
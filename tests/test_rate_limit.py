@@ -0,0 +1,20 @@
+"""Rate limit parsing and per-user token buckets."""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import main  # noqa: E402
+
+
+def test_invalid_budgets_are_ignored():
+    limits = main.parse_rate_limits("start=1/0,buy=0/5,receipt=-1/2,default=3/6")
+    assert limits == {"default": (3.0, 0.5)}
+
+
+def test_full_table_does_not_evict_the_callers_bucket():
+    limiter = main.RateLimiter({"default": (1, 0.001)}, max_users=2)
+    assert limiter.hit(1, "default")
+    assert limiter.hit(2, "default")
+    # کاربر ۱ قدیمی‌ترین سطل جدول پر است ولی نباید سطل پر تازه بگیرد
+    assert not limiter.hit(1, "default")